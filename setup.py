@@ -30,13 +30,20 @@ setup(
         'Flask-Mako',
         'lxml'
     ],
+    extras_require={
+        'gevent': ['gevent'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     download_users = presence_analyzer.script:download_users
+    presence-bench = presence_analyzer.bench:run
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
     debug = presence_analyzer.script:make_debug
+
+    [paste.server_runner]
+    gevent = presence_analyzer.serving:serve
     """,
 )
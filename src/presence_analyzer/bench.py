@@ -0,0 +1,566 @@
+# -*- coding: utf-8 -*-
+"""
+Performance benchmarks.
+
+Loaders and API views are benchmarked on synthetic data by
+`bin/presence-bench`, see `run`. Variants of loaders are compared by
+`bin/presence-bench --loaders`, see `run_loaders`, and running server is
+load tested by `bin/presence-bench --load-test URL`, see `load_test`.
+"""
+import os
+import csv
+import sys
+import json
+import locale
+import random
+import shutil
+import platform
+import tempfile
+from argparse import ArgumentParser
+from datetime import date, datetime, timedelta
+from multiprocessing import cpu_count
+from timeit import default_timer
+from urlparse import urljoin, urlsplit
+
+from lxml import etree
+from pkg_resources import DistributionNotFound, get_distribution
+
+try:
+    import gevent
+    from gevent import socket as green_socket
+except ImportError:  # pragma: no cover
+    gevent = None  # pylint: disable=invalid-name
+
+from presence_analyzer import dataset, directory, ingest, snapshot, utils
+from presence_analyzer.main import app
+
+
+FIRST_NAMES = [
+    u'Adam', u'Agnieszka', u'Łukasz', u'Ewa', u'Żaneta', u'Zenon',
+    u'Ścibor', u'Anna', u'Tomasz', u'Ćwikła', u'Olga', u'Marek',
+]
+
+
+def parse_rows_strptime(lines):
+    """
+    Reference parser calling `strptime` for every field, as before.
+    """
+    for row in csv.reader(lines, delimiter=','):
+        if len(row) != 4:
+            continue
+        try:
+            user_id = int(row[0])
+            day = datetime.strptime(row[1], '%Y-%m-%d').date()
+            start = datetime.strptime(row[2], '%H:%M:%S').time()
+            end = datetime.strptime(row[3], '%H:%M:%S').time()
+        except (ValueError, TypeError):
+            continue
+        yield (
+            user_id,
+            day.toordinal(),
+            start.hour * 3600 + start.minute * 60 + start.second,
+            end.hour * 3600 + end.minute * 60 + end.second,
+        )
+
+
+def load_users_xpath(path):
+    """
+    Reference users loader using XPath and `strcoll` comparator, as before.
+    """
+    xml = etree.parse(path)
+    api_server = '%s://%s' % (
+        xml.findtext('./server/protocol'), xml.findtext('./server/host')
+    )
+    data = [
+        {
+            'id': user.get('id'),
+            'avatar': urljoin(api_server, user.findtext('avatar')),
+            'name': user.findtext('name')
+        }
+        for user in xml.xpath('./users/user')
+    ]
+    data.sort(key=lambda x: x['name'], cmp=locale.strcoll)
+    return data
+
+
+def measure(func, repeat):
+    """
+    Returns the best time in seconds of `repeat` calls of given function.
+    """
+    best = None
+    for _ in xrange(repeat):
+        started = default_timer()
+        func()
+        elapsed = default_timer() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_parse(path, repeat=3):
+    """
+    Compares rows per second of the `strptime` and fixed layout parsers.
+    """
+    with open(path, 'rb') as csvfile:
+        lines = csvfile.read().splitlines()
+
+    results = []
+    for name, parse in [
+            ('strptime', parse_rows_strptime),
+            ('fixed layout', ingest.parse_rows),
+    ]:
+        rows = sum(1 for _ in parse(lines))
+        seconds = measure(lambda: sum(1 for _ in parse(lines)), repeat)
+        results.append((name, rows, seconds))
+    return results
+
+
+def bench_load(path, repeat=3):
+    """
+    Compares seconds of loading data by parsing CSV and from its snapshot.
+    """
+    identity = dataset.file_identity(path)
+    data = ingest.load_presence(path)
+    snapshot.write_snapshot(path, identity, data)
+    try:
+        return [
+            ('parse', measure(lambda: ingest.load_presence(path), repeat)),
+            ('snapshot', measure(
+                lambda: snapshot.read_snapshot(path, identity), repeat
+            )),
+        ]
+    finally:
+        os.remove(snapshot.snapshot_path(path))
+
+
+def bench_parallel(path, repeat=3):
+    """
+    Compares seconds of loading data by different numbers of processes.
+
+    Numbers of processes are powers of two up to twice the number of cores.
+    """
+    results = []
+    processes = 1
+    while processes <= 2 * cpu_count():
+        results.append((processes, measure(
+            lambda: ingest.load_presence(path, processes=processes), repeat
+        )))
+        processes *= 2
+    return results
+
+
+def bench_users(path, repeat=3):
+    """
+    Compares seconds of loading users with XPath and into UserDirectory.
+    """
+    return [
+        ('xpath', measure(lambda: load_users_xpath(path), repeat)),
+        ('iterparse', measure(
+            lambda: directory.load_directory(path), repeat
+        )),
+    ]
+
+
+def generate_csv(path, users, years, seed=0):
+    """
+    Writes presence of users on workdays of given number of years to CSV.
+
+    About every tenth workday of every user is skipped. Returns number of
+    written rows.
+    """
+    rand = random.Random(seed)
+    first = date(2013, 1, 1)
+    days = [
+        first + timedelta(days=i)
+        for i in xrange((date(first.year + years, 1, 1) - first).days)
+    ]
+    rows = 0
+    with open(path, 'wb') as csvfile:
+        for user_id in xrange(1, users + 1):
+            for day in days:
+                if day.weekday() > 4 or rand.random() < 0.1:
+                    continue
+                start = rand.randint(7 * 3600, 10 * 3600)
+                end = start + rand.randint(4 * 3600, 9 * 3600)
+                csvfile.write(utils.csv_record(
+                    user_id, day.toordinal(), start, end
+                ))
+                rows += 1
+    return rows
+
+
+def generate_users_xml(path, users, seed=0):
+    """
+    Writes users directory XML in the format of the intranet.
+    """
+    rand = random.Random(seed)
+    root = etree.Element('intranet')
+    server = etree.SubElement(root, 'server')
+    etree.SubElement(server, 'host').text = 'intranet.example.com'
+    etree.SubElement(server, 'port').text = '443'
+    etree.SubElement(server, 'protocol').text = 'https'
+    users_element = etree.SubElement(root, 'users')
+    for user_id in xrange(1, users + 1):
+        user = etree.SubElement(users_element, 'user', id=str(user_id))
+        etree.SubElement(user, 'avatar').text = \
+            '/api/images/users/%d' % user_id
+        etree.SubElement(user, 'name').text = u'%s %s.' % (
+            rand.choice(FIRST_NAMES), unichr(ord('A') + rand.randint(0, 25))
+        )
+    etree.ElementTree(root).write(
+        path, encoding='UTF-8', xml_declaration=True
+    )
+
+
+def reset_app():
+    """
+    Drops loaded data and cached responses, as in a new process.
+    """
+    for storage in (utils.get_data.dataset, utils.get_sqlite_data.dataset,
+                    utils.get_data_v2.dataset):
+        storage.snapshot = storage.stale = None
+    for view in app.view_functions.itervalues():
+        if hasattr(view, 'cache'):
+            view.cache.clear()
+
+
+def time_cold_warm(func, reset, repeat):
+    """
+    Returns seconds of the first call after reset and the best next one.
+    """
+    reset()
+    started = default_timer()
+    func()
+    cold = default_timer() - started
+    return cold, measure(func, repeat)
+
+
+def package_version():
+    """
+    Returns version of installed presence_analyzer or None.
+    """
+    try:
+        return get_distribution('presence_analyzer').version
+    except DistributionNotFound:
+        return None
+
+
+def environment():
+    """
+    Returns versions of the package and Python, platform and CPU count.
+    """
+    return {
+        'version': package_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': cpu_count(),
+    }
+
+
+def run_suite(users, years, repeat=5, seed=0):
+    """
+    Benchmarks loaders and API views on generated data.
+
+    Returns results as a dict, which can be serialized to JSON.
+    """
+    tmpdir = tempfile.mkdtemp()
+    csv_path = os.path.join(tmpdir, 'data.csv')
+    xml_path = os.path.join(tmpdir, 'users.xml')
+    config = dict(app.config)
+    try:
+        rows = generate_csv(csv_path, users, years, seed)
+        generate_users_xml(xml_path, users, seed)
+        app.config.update({
+            'DATA_CSV': csv_path,
+            'XML_FILE_PATH': xml_path,
+            'DATA_SOURCE': 'csv',
+            'DATA_SNAPSHOT': False,
+            'DATA_MMAP': False,
+        })
+        client = app.test_client()
+        user_id = max(1, users // 2)
+
+        def request(url):
+            """
+            Returns function requesting given URL.
+            """
+            def get():
+                """
+                Requests the URL and reads the whole response.
+                """
+                response = client.get(url)
+                assert response.status_code == 200, url
+                return response.data
+            return get
+
+        cases = [
+            ('get_data', utils.get_data),
+            ('get_data_v2', utils.get_data_v2),
+            ('group_by_weekday',
+             lambda: utils.group_by_weekday(utils.get_data()[user_id])),
+        ]
+        urls = [
+            '/api/v1/users',
+            '/api/v1/mean_time_weekday/%d' % user_id,
+            '/api/v1/presence_weekday/%d' % user_id,
+            '/api/v1/presence_weekday/%d?from=2013-06-01&to=2013-12-31' %
+            user_id,
+            '/api/v1/presence_start_end/%d' % user_id,
+            '/api/v1/mean_start_end/%d' % user_id,
+            '/api/v1/stats?user_id=all',
+            '/api/v1/team/presence_weekday',
+            '/api/v1/export',
+        ]
+        cases.extend((url, request(url)) for url in urls)
+
+        results = []
+        for name, func in cases:
+            cold, warm = time_cold_warm(func, reset_app, repeat)
+            results.append({'name': name, 'cold': cold, 'warm': warm})
+    finally:
+        app.config.clear()
+        app.config.update(config)
+        reset_app()
+        shutil.rmtree(tmpdir)
+
+    result = environment()
+    result.update({
+        'users': users,
+        'years': years,
+        'rows': rows,
+        'repeat': repeat,
+        'seed': seed,
+        'results': results,
+    })
+    return result
+
+
+# pylint: disable=too-many-arguments
+def run_loaders(users, years, repeat=3, seed=0, csv_path=None,
+                xml_path=None):
+    """
+    Compares variants of loaders on given or generated data files.
+
+    Data is generated like by `run_suite` for files which are not given.
+    Returns results as a dict, which can be serialized to JSON.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        if csv_path is None:
+            csv_path = os.path.join(tmpdir, 'data.csv')
+            generate_csv(csv_path, users, years, seed)
+        if xml_path is None:
+            xml_path = os.path.join(tmpdir, 'users.xml')
+            generate_users_xml(xml_path, users, seed)
+        results = [
+            {'name': 'parse', 'variant': name, 'rows': rows,
+             'seconds': seconds}
+            for name, rows, seconds in bench_parse(csv_path, repeat)
+        ]
+        results.extend(
+            {'name': 'load', 'variant': name, 'seconds': seconds}
+            for name, seconds in bench_load(csv_path, repeat)
+        )
+        results.extend(
+            {'name': 'parallel load', 'variant': '%d processes' % processes,
+             'seconds': seconds}
+            for processes, seconds in bench_parallel(csv_path, repeat)
+        )
+        results.extend(
+            {'name': 'users', 'variant': name, 'seconds': seconds}
+            for name, seconds in bench_users(xml_path, repeat)
+        )
+    finally:
+        shutil.rmtree(tmpdir)
+
+    result = environment()
+    result.update({
+        'users': users,
+        'years': years,
+        'repeat': repeat,
+        'seed': seed,
+        'csv': csv_path,
+        'xml': xml_path,
+        'results': results,
+    })
+    return result
+
+
+def read_response(stream):
+    """
+    Reads HTTP response from file-like stream.
+
+    Returns (status, body, whether the connection is kept alive).
+    """
+    version, status = stream.readline().split()[:2]
+    keep_alive = version == 'HTTP/1.1'
+    length = None
+    chunked = False
+    while True:
+        line = stream.readline()
+        if line in ('\r\n', '\n', ''):
+            break
+        name, _, value = line.partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'transfer-encoding':
+            chunked = 'chunked' in value.lower()
+        elif name == 'connection':
+            keep_alive = value.strip().lower() == 'keep-alive'
+
+    if not chunked:
+        if length is None:
+            return int(status), stream.read(), False
+        return int(status), stream.read(length), keep_alive
+    body = []
+    while True:
+        size = int(stream.readline().split(';')[0], 16)
+        if not size:
+            # trailer
+            while stream.readline() not in ('\r\n', '\n', ''):
+                pass
+            return int(status), ''.join(body), keep_alive
+        body.append(stream.read(size))
+        stream.readline()
+
+
+def percentiles(values, points=(50, 90, 99, 100)):
+    """
+    Returns {'pN': value} dict of given percentiles of values.
+    """
+    values = sorted(values)
+    result = {}
+    for point in points:
+        i = min(len(values) - 1, len(values) * point // 100)
+        result['p%d' % point] = values[i] if values else None
+    return result
+
+
+def load_test(url, connections=1000, requests=10, idle=0, timeout=60):
+    """
+    Load tests running server with many concurrent connections.
+
+    Every one of `connections` clients sends `requests` GET requests of url
+    one after another, over one connection if the server keeps it alive,
+    while `idle` more connections send just a part of request and wait,
+    like slow clients. Returns requests per second, latency percentiles in
+    seconds and number of failed requests. Clients still running after
+    `timeout` seconds are stopped and their missing requests count as
+    failed. Requires optional gevent package.
+    """
+    if gevent is None:
+        raise RuntimeError('Load testing requires gevent')
+    parts = urlsplit(url)
+    address = (parts.hostname, parts.port or 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    request = 'GET {0} HTTP/1.1\r\nHost: {1}\r\n\r\n'.format(
+        path, parts.netloc
+    )
+    latencies = []
+    sockets = []
+
+    def client():
+        """
+        Sends requests one after another until one fails.
+        """
+        sock = None
+        try:
+            for _ in xrange(requests):
+                started = default_timer()
+                if sock is None:
+                    sock = green_socket.create_connection(address)
+                    sockets.append(sock)
+                    stream = sock.makefile('rb')
+                sock.sendall(request)
+                status, _, keep_alive = read_response(stream)
+                if status != 200:
+                    return
+                latencies.append(default_timer() - started)
+                if not keep_alive:
+                    sock.close()
+                    sock = None
+        except (green_socket.error, IndexError, ValueError):
+            return
+
+    def idle_client():
+        """
+        Sends incomplete request and waits.
+        """
+        try:
+            sock = green_socket.create_connection(address)
+            sockets.append(sock)
+            sock.sendall(request[:len(request) // 2])
+        except green_socket.error:
+            return
+        gevent.sleep(timeout)
+
+    idlers = [gevent.spawn(idle_client) for _ in xrange(idle)]
+    gevent.sleep(0.5 if idle else 0)
+    started = default_timer()
+    clients = [gevent.spawn(client) for _ in xrange(connections)]
+    gevent.joinall(clients, timeout=timeout)
+    elapsed = default_timer() - started
+    gevent.killall(clients + idlers)
+    for sock in sockets:
+        sock.close()
+    return {
+        'url': url,
+        'connections': connections,
+        'idle': idle,
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed,
+        'failed': connections * requests - len(latencies),
+        'latency': percentiles(latencies),
+    }
+
+
+def run(argv=None):
+    """
+    Benchmarks loaders and API views, prints results as JSON.
+
+    Cold time is the first call after dropping loaded data and cached
+    responses, warm time is the best of the following calls. With --loaders,
+    variants of loaders are compared instead, on --csv and --xml files if
+    given, see `run_loaders`. With --load-test URL, running server is load
+    tested instead, see `load_test`.
+    """
+    parser = ArgumentParser(description=run.__doc__.strip().split('\n')[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--years', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--output', help='write results to file instead of stdout'
+    )
+    parser.add_argument('--loaders', action='store_true')
+    parser.add_argument('--csv', help='presence data for --loaders')
+    parser.add_argument('--xml', help='users data for --loaders')
+    parser.add_argument('--load-test', metavar='URL')
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=10)
+    parser.add_argument('--idle', type=int, default=0)
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    if args.load_test:
+        results = load_test(
+            args.load_test, args.connections, args.requests, args.idle
+        )
+    elif args.loaders:
+        results = run_loaders(
+            args.users, args.years, args.repeat, args.seed, args.csv,
+            args.xml,
+        )
+    else:
+        results = run_suite(args.users, args.years, args.repeat, args.seed)
+    body = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(body + '\n')
+    else:
+        print body
+
+
+if __name__ == '__main__':
+    run()
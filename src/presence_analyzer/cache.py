@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory caching utilities.
+"""
+from collections import OrderedDict
+from threading import Lock
+# pylint: disable=redefined-outer-name
+from time import time
+
+
+def is_expired(last_time, cache_time):
+    """
+    Checks if given time is expired.
+    """
+    return last_time + cache_time < time()
+
+
+class LRUCache(object):
+    """
+    Bounded mapping with least recently used eviction and per entry TTL.
+
+    Every entry is stored as a (stored_at, value) tuple. Entries older than
+    `ttl` seconds are treated as missing, and when `max_size` is exceeded
+    the least recently used entry is dropped.
+    """
+
+    def __init__(self, max_size=128, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Returns cached value for given key or default if missing or expired.
+
+        Lookups don't wait for the lock. Recency bookkeeping is skipped when
+        other thread is holding it, so under contention eviction order is
+        only approximately LRU.
+        """
+        entry = self._entries.get(key)
+        if entry is None or self._is_stale(entry):
+            self.misses += 1
+            if entry is not None:
+                self._update(key, entry, keep=False)
+            return default
+        self.hits += 1
+        self._update(key, entry, keep=True)
+        return entry[1]
+
+    def set(self, key, value):
+        """
+        Stores value under given key, evicting least recently used entries.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time(), value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Removes all entries and resets counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        Returns dict with cache counters.
+        """
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _update(self, key, entry, keep):
+        """
+        Marks entry as the most recently used or drops it, if lock is free.
+        """
+        if not self._lock.acquire(False):
+            return
+        try:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+                if keep:
+                    self._entries[key] = entry
+        finally:
+            self._lock.release()
+
+    def _is_stale(self, entry):
+        """
+        Checks if given entry outlived cache TTL.
+        """
+        return self.ttl is not None and is_expired(entry[0], self.ttl)
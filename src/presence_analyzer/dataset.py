@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Datasets shared between request threads.
+"""
+import os
+import logging
+from collections import namedtuple
+from hashlib import md5
+from threading import Event, Lock, Thread
+# pylint: disable=redefined-outer-name
+from time import time
+
+from presence_analyzer.metrics import (
+    LOCK_WAIT_SECONDS,
+    RELOAD_SECONDS,
+    in_request,
+    span,
+)
+
+try:
+    import pyinotify
+except ImportError:  # pragma: no cover
+    pyinotify = None  # pylint: disable=invalid-name
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+Snapshot = namedtuple('Snapshot', 'data loaded_at identity version')
+
+
+def file_identity(path):
+    """
+    Returns (path, mtime, size, inode) tuple describing given file.
+
+    Missing file is described by its path only.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return (path,)
+    return (path, stat.st_mtime, stat.st_size, stat.st_ino)
+
+
+class Dataset(object):
+    """
+    Holds the latest immutable snapshot of data produced by a loader.
+
+    Readers only fetch the current snapshot reference, so they never block
+    while it is fresh. The per dataset lock is taken only by the thread which
+    rebuilds changed data, and the new snapshot is published with a single
+    attribute assignment.
+
+    Data is rebuilt only when identity (mtime, size and inode) of one of the
+    `sources` files changes. Identities are checked at most once per
+    `check_interval` seconds, unless the list of source paths itself changes.
+    Snapshot whose files changed less than `max_staleness` seconds ago is
+    still served while a background thread rebuilds it.
+
+    Loader of `incremental` dataset is called with data of the previous
+    snapshot (None for the first or forced full load), which it must not
+    modify.
+
+    Rebuilds are run by `executor` if set, a thread pool with `apply(func,
+    args)` method like the one of event loop server, so waiting for the lock
+    and loading never block the loop.
+    """
+
+    executor = None
+
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+    def __init__(self, load, sources=None, check_interval=0, max_staleness=0,
+                 incremental=False):
+        self.load = load
+        self.incremental = incremental
+        self.name = load.__name__
+        self.sources = sources or (lambda: [])
+        self.check_interval = check_interval
+        self.max_staleness = max_staleness
+        self.lock = Lock()
+        self.snapshot = None
+        self.checked_at = 0
+        # (snapshot, time) of the latest snapshot known to be outdated
+        self.stale = None
+
+    def get(self):
+        """
+        Returns data from the current snapshot.
+        """
+        return self.current().data
+
+    def current(self):
+        """
+        Returns the current snapshot, rebuilding it if its files changed.
+        """
+        snapshot = self.snapshot
+        if snapshot is None:
+            snapshot = self.refresh(snapshot)
+        elif self.is_stale(snapshot):
+            if self.stale[1] + self.max_staleness > time():
+                self.refresh_async(snapshot)
+            else:
+                snapshot = self.refresh(snapshot)
+        return snapshot
+
+    def identity(self, paths=None):
+        """
+        Returns identities of source files.
+        """
+        if paths is None:
+            paths = self.sources()
+        return tuple(file_identity(path) for path in paths)
+
+    def is_stale(self, snapshot, force=False):
+        """
+        Checks if source files changed since given snapshot was loaded.
+
+        Files are not examined again within `check_interval` from the
+        previous check, unless `force` is set.
+        """
+        stale = self.stale
+        if stale is not None and stale[0] is snapshot:
+            return True
+
+        paths = tuple(self.sources())
+        now = time()
+        if not force and now < self.checked_at + self.check_interval and \
+                paths == tuple(item[0] for item in snapshot.identity):
+            return False
+
+        self.checked_at = now
+        if self.identity(paths) == snapshot.identity:
+            return False
+        self.stale = (snapshot, now)
+        return True
+
+    def invalidate(self):
+        """
+        Marks the current snapshot as outdated.
+        """
+        snapshot = self.snapshot
+        if snapshot is not None:
+            self.stale = (snapshot, time())
+
+    def refresh(self, seen=None, full=False):
+        """
+        Rebuilds snapshot unless other thread replaced `seen` one meanwhile.
+        """
+        executor = self.executor
+        if executor is not None:
+            return executor.apply(in_request(self._refresh), (seen, full))
+        return self._refresh(seen, full)
+
+    def _refresh(self, seen, full):
+        """
+        Rebuilds snapshot in the current thread, see `refresh`.
+        """
+        with span('lock', LOCK_WAIT_SECONDS, self.name):
+            self.lock.acquire()
+        try:
+            return self._rebuild(seen, full)
+        finally:
+            self.lock.release()
+
+    def refresh_async(self, seen=None):
+        """
+        Rebuilds snapshot in a background thread.
+
+        Returns the started thread or None if the dataset is being rebuilt
+        already.
+        """
+        if not self.lock.acquire(False):
+            return None
+
+        def run():
+            """
+            Rebuilds snapshot and releases the lock taken by the caller.
+            """
+            try:
+                self._rebuild(seen)
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Refreshing %s failed', self.name)
+            finally:
+                self.lock.release()
+
+        thread = Thread(target=run, name='refresh-%s' % self.name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def reload(self):
+        """
+        Unconditionally rebuilds snapshot from scratch.
+        """
+        return self.refresh(self.snapshot, full=True)
+
+    def _rebuild(self, seen, full=False):
+        """
+        Loads and publishes new snapshot. Must be called with lock held.
+        """
+        snapshot = self.snapshot
+        if snapshot is seen:
+            # identity is taken first, so changes made while loading
+            # are detected by the next check
+            loaded_at = time()
+            identity = self.identity()
+            with span('load', RELOAD_SECONDS, self.name):
+                if not self.incremental:
+                    data = self.load()
+                elif full or seen is None:
+                    data = self.load(None)
+                else:
+                    data = self.load(seen.data)
+            snapshot = Snapshot(
+                data,
+                loaded_at,
+                identity,
+                md5(repr(identity)).hexdigest(),
+            )
+            self.snapshot = snapshot
+            self.checked_at = loaded_at
+            log.debug('Dataset %s reloaded', self.name)
+        return snapshot
+
+
+class Switch(object):
+    """
+    Dataset chosen among others by a function, e.g. depending on settings.
+    """
+
+    def __init__(self, choose):
+        self.choose = choose
+
+    def get(self):
+        """
+        Returns data from the current snapshot of the chosen dataset.
+        """
+        return self.current().data
+
+    def current(self):
+        """
+        Returns the current snapshot of the chosen dataset.
+        """
+        return self.choose().current()
+
+
+class Refresher(Thread):
+    """
+    Daemon thread polling dataset files and rebuilding changed datasets.
+    """
+
+    def __init__(self, datasets, interval):
+        super(Refresher, self).__init__(name='dataset-refresher')
+        self.daemon = True
+        self.datasets = datasets
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        """
+        Loads missing and rebuilds changed datasets every `interval` seconds.
+        """
+        while True:
+            for dataset in self.datasets:
+                snapshot = dataset.snapshot
+                if snapshot is not None and \
+                        not dataset.is_stale(snapshot, force=True):
+                    continue
+                try:
+                    dataset.refresh(snapshot)
+                except Exception:  # pylint: disable=broad-except
+                    log.exception('Refreshing %s failed', dataset.name)
+            if self.stopped.wait(self.interval):
+                break
+
+    def stop(self):
+        """
+        Stops the thread after the current check.
+        """
+        self.stopped.set()
+
+
+class Watcher(Thread):
+    """
+    Daemon thread rebuilding datasets as soon as inotify reports changes.
+
+    Whole directories are watched, so files replaced by rename are noticed
+    too. Requires optional pyinotify package.
+    """
+
+    def __init__(self, datasets, timeout=1000):
+        if pyinotify is None:
+            raise RuntimeError('Watching data files requires pyinotify')
+        super(Watcher, self).__init__(name='dataset-watcher')
+        self.daemon = True
+        self.datasets = datasets
+        self.timeout = timeout
+        self.stopped = Event()
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self.handle)
+        mask = (
+            pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+            pyinotify.IN_CREATE | pyinotify.IN_DELETE
+        )
+        directories = set(
+            os.path.dirname(os.path.abspath(path))
+            for dataset in datasets for path in dataset.sources()
+        )
+        for directory in directories:
+            self.manager.add_watch(directory, mask)
+
+    def handle(self, event):
+        """
+        Rebuilds datasets using file from given event.
+        """
+        for dataset in self.datasets:
+            paths = [os.path.abspath(path) for path in dataset.sources()]
+            if event.pathname in paths:
+                dataset.invalidate()
+                dataset.refresh_async(dataset.snapshot)
+
+    def run(self):
+        """
+        Processes inotify events until stopped.
+        """
+        while not self.stopped.is_set():
+            if self.notifier.check_events(self.timeout):
+                self.notifier.read_events()
+                self.notifier.process_events()
+        self.notifier.stop()
+
+    def stop(self):
+        """
+        Stops the thread within `timeout` milliseconds.
+        """
+        self.stopped.set()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Directory of users with names and avatars.
+"""
+import locale
+from json import dumps
+from urlparse import urljoin
+
+from lxml import etree
+
+
+def sort_key(name):
+    """
+    Returns key sorting names like `locale.strcoll` in the current locale.
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return locale.strxfrm(name)
+
+
+class UserDirectory(list):
+    """
+    Users sorted by name, as {'id': ..., 'name': ..., 'avatar': ...} dicts.
+
+    `index` maps integer user ids to the same dicts and `body` holds the
+    list already serialized to JSON.
+    """
+
+    def __init__(self, users=()):
+        decorated = [(sort_key(user['name']), user) for user in users]
+        decorated.sort(key=lambda item: item[0])
+        super(UserDirectory, self).__init__(user for _, user in decorated)
+        self.index = dict((int(user['id']), user) for user in self)
+        self.body = dumps(self)
+
+    def get_user(self, user_id):
+        """
+        Returns user with given id or None.
+        """
+        return self.index.get(user_id)
+
+
+def join_url(server, path):
+    """
+    Returns absolute URL of given path on server.
+    """
+    if path.startswith('/') and not path.startswith('//'):
+        # what urljoin returns for absolute paths, but much faster
+        return server + path
+    return urljoin(server, path)
+
+
+def load_directory(path):
+    """
+    Loads UserDirectory from XML file.
+
+    The file is parsed incrementally and elements of parsed users are
+    freed, so the whole document tree is never kept in memory.
+    """
+    server = {}
+    users = []
+    for _, element in etree.iterparse(path, events=('end',)):
+        tag = element.tag
+        if tag == 'user':
+            users.append({
+                'id': element.get('id'),
+                'avatar': element.findtext('avatar') or '',
+                'name': element.findtext('name'),
+            })
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        elif tag in ('protocol', 'host') and \
+                element.getparent().tag == 'server':
+            server[tag] = element.text
+
+    api_server = '%s://%s' % (server.get('protocol'), server.get('host'))
+    for user in users:
+        user['avatar'] = join_url(api_server, user['avatar'])
+    return UserDirectory(users)
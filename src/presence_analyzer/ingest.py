@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data ingestion.
+"""
+import os
+import csv
+import logging
+from collections import Counter
+from datetime import date, datetime
+from functools import partial
+from multiprocessing import Pool
+
+from presence_analyzer.store import PresenceStore, UserPresence, columns
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+TAIL_SIZE = 64
+# smaller chunks of data are not worth starting processes
+PARALLEL_MIN_SIZE = 1 << 20
+# kinds of problems counted in data-quality reports
+FLAGS = ('rejected', 'non_positive', 'duplicates', 'outliers')
+# longer intervals are suspicious
+OUTLIER_SECONDS = 16 * 3600
+
+
+def parse_date(value):
+    """
+    Parses date in YYYY-MM-DD format.
+
+    Values not matching the fixed layout fall back to `strptime`, which is
+    several times slower but also accepts e.g. not zero padded fields.
+    """
+    if len(value) == 10 and value[4] == '-' and value[7] == '-':
+        digits = value[:4] + value[5:7] + value[8:]
+        if digits.isdigit():
+            return date(int(value[:4]), int(value[5:7]), int(value[8:]))
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def parse_seconds(value):
+    """
+    Parses time in HH:MM:SS format into seconds since midnight.
+
+    See `parse_date` for the fallback.
+    """
+    if len(value) == 8 and value[2] == ':' and value[5] == ':':
+        digits = value[:2] + value[3:5] + value[6:]
+        if digits.isdigit():
+            hour, minute, second = (
+                int(value[:2]), int(value[3:5]), int(value[6:])
+            )
+            if hour > 23 or minute > 59 or second > 59:
+                raise ValueError('Time out of range: %s' % value)
+            return hour * 3600 + minute * 60 + second
+    parsed = datetime.strptime(value, '%H:%M:%S')
+    return parsed.hour * 3600 + parsed.minute * 60 + parsed.second
+
+
+def parse_rows(lines, quality=None, exclude_flagged=False):
+    """
+    Yields (user_id, day, start, end) tuples parsed from CSV lines.
+
+    Day is a date ordinal, start and end are seconds since midnight. Header,
+    footer and malformed lines are skipped.
+
+    Problems are counted in `quality` dict of {user_id: Counter} if given:
+    malformed lines as `rejected` (under None when even the user id is
+    broken), intervals ending before they start as `non_positive` and ones
+    longer than OUTLIER_SECONDS as `outliers`. With `exclude_flagged`,
+    flagged rows are skipped too.
+    """
+    for i, row in enumerate(csv.reader(lines, delimiter=',')):
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+
+        try:
+            user_id = int(row[0])
+            day = parse_date(row[1]).toordinal()
+            start = parse_seconds(row[2])
+            end = parse_seconds(row[3])
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+            if quality is not None:
+                user_id = int(row[0]) if row[0].isdigit() else None
+                quality.setdefault(user_id, Counter())['rejected'] += 1
+            continue
+
+        if 0 < end - start <= OUTLIER_SECONDS:
+            yield user_id, day, start, end
+            continue
+
+        if quality is not None:
+            flag = 'non_positive' if end <= start else 'outliers'
+            quality.setdefault(user_id, Counter())[flag] += 1
+        if not exclude_flagged:
+            yield user_id, day, start, end
+
+
+def merge_quality(target, source, sign=1):
+    """
+    Adds (or subtracts) counts of `source` quality report to `target`.
+
+    Reports are {user_id: Counter} dicts, see `parse_rows`.
+    """
+    for user_id, counts in source.iteritems():
+        total = target.setdefault(user_id, Counter())
+        if sign > 0:
+            total.update(counts)
+        else:
+            total.subtract(counts)
+        if not any(total.itervalues()):
+            del target[user_id]
+
+
+def is_appended(csvfile, previous):
+    """
+    Checks if file was only appended since `previous` data was parsed.
+
+    Only the bytes right before the previous offset are compared, so rows
+    rewritten in place further back are not noticed.
+    """
+    stat = os.fstat(csvfile.fileno())
+    if stat.st_ino != previous.inode or stat.st_size < previous.offset:
+        # rotated or truncated
+        return False
+    csvfile.seek(previous.offset - len(previous.tail))
+    return csvfile.read(len(previous.tail)) == previous.tail
+
+
+def parse_columns(chunk, exclude_flagged=False):
+    """
+    Parses CSV chunk into {user_id: (days, starts, ends)} columns.
+
+    Entries of every user are kept in the order of lines. Returns the
+    columns with quality report of the chunk, see `parse_rows`.
+    """
+    result = {}
+    quality = {}
+    for user_id, day, start, end in parse_rows(
+            chunk.splitlines(), quality, exclude_flagged):
+        try:
+            days, starts, ends = result[user_id]
+        except KeyError:
+            result[user_id] = days, starts, ends = columns()
+        days.append(day)
+        starts.append(start)
+        ends.append(end)
+    return result, quality
+
+
+def parse_packed(chunk, exclude_flagged=False):
+    """
+    Like `parse_columns`, but columns are packed into strings.
+
+    Used by worker processes, strings are much faster to pickle.
+    """
+    result, quality = parse_columns(chunk, exclude_flagged)
+    return dict(
+        (user_id, tuple(column.tostring() for column in user_columns))
+        for user_id, user_columns in result.iteritems()
+    ), quality
+
+
+def unpack(packed):
+    """
+    Returns columns and quality report packed by `parse_packed`.
+    """
+    packed, quality = packed
+    result = {}
+    for user_id, user_columns in packed.iteritems():
+        result[user_id] = columns()
+        for column, value in zip(result[user_id], user_columns):
+            column.fromstring(value)
+    return result, quality
+
+
+def split_lines(chunk, count):
+    """
+    Splits chunk into at most `count` parts of similar size at line ends.
+    """
+    bounds = [0]
+    for i in xrange(1, count):
+        end = chunk.find('\n', max(len(chunk) * i // count, bounds[-1]))
+        if end < 0:
+            break
+        bounds.append(end + 1)
+    bounds.append(len(chunk))
+    return [
+        chunk[bounds[i]:bounds[i + 1]]
+        for i in xrange(len(bounds) - 1) if bounds[i] < bounds[i + 1]
+    ]
+
+
+def parse_parallel(chunk, processes, exclude_flagged=False):
+    """
+    Parses CSV chunk in a pool of processes.
+
+    Returns list of `parse_columns` results of consecutive parts of chunk.
+    """
+    pool = Pool(processes)
+    try:
+        return [
+            unpack(packed)
+            for packed in pool.map(
+                partial(parse_packed, exclude_flagged=exclude_flagged),
+                split_lines(chunk, processes),
+            )
+        ]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_presence(path, previous=None, processes=None,
+                  exclude_flagged=False):
+    """
+    Parses presence CSV file into PresenceStore.
+
+    If the file was only appended since `previous` data was parsed, just the
+    new rows are parsed and merged into its copy. Columns of users with new
+    rows are copied before they are changed, so `previous` data stays intact.
+
+    With more than one of `processes`, large chunks of data are split at
+    line ends and parsed in parallel. Parts are merged in the order of the
+    file, so the last of duplicated entries still wins.
+
+    Quality report of the whole file is built in the same pass, see
+    `parse_rows`, and kept as `quality` of the data. Entries replaced by a
+    later one of the same user and day are counted as `duplicates`. With
+    `exclude_flagged`, flagged rows are left out of the data.
+    """
+    with open(path, 'rb') as csvfile:
+        if previous is not None and is_appended(csvfile, previous):
+            data = PresenceStore(previous)
+            offset, tail = previous.offset, previous.tail
+            quality = dict(
+                (user_id, counts.copy())
+                for user_id, counts in previous.quality.iteritems()
+            )
+            # the unterminated line is parsed again below
+            merge_quality(quality, previous.pending_quality, -1)
+            pending = previous.pending
+        else:
+            data = PresenceStore()
+            offset, tail = 0, ''
+            quality = {}
+            pending = None
+        csvfile.seek(offset)
+        chunk = csvfile.read()
+        inode = os.fstat(csvfile.fileno()).st_ino
+
+    # unterminated last line is parsed again with the next update,
+    # in case it wasn't completely written yet
+    end = chunk.rfind('\n') + 1
+    if processes > 1 and end >= PARALLEL_MIN_SIZE:
+        parts = parse_parallel(chunk[:end], processes, exclude_flagged)
+    else:
+        parts = [parse_columns(chunk[:end], exclude_flagged)]
+    last_part = parse_columns(chunk[end:], exclude_flagged)
+    parts.append(last_part)
+
+    updates = {}
+    for part, part_quality in parts:
+        merge_quality(quality, part_quality)
+        for user_id, (days, starts, ends) in part.iteritems():
+            try:
+                user_columns = updates[user_id]
+            except KeyError:
+                user = data.get(user_id)
+                if user is None:
+                    user_columns = updates[user_id] = days, starts, ends
+                    continue
+                user_columns = updates[user_id] = columns(
+                    user.days, user.starts, user.ends
+                )
+            for column, values in zip(user_columns, (days, starts, ends)):
+                column.extend(values)
+
+    for user_id, user_columns in updates.iteritems():
+        user = data[user_id] = UserPresence.build(*user_columns)
+        duplicates = len(user_columns[0]) - len(user)
+        if user_id == pending and duplicates:
+            # entry of the unterminated line replaced by itself
+            duplicates -= 1
+        if duplicates:
+            quality.setdefault(user_id, Counter())['duplicates'] += \
+                duplicates
+
+    data.inode = inode
+    data.offset = offset + end
+    data.tail = (tail + chunk[max(0, end - TAIL_SIZE):end])[-TAIL_SIZE:]
+    data.quality = quality
+    data.pending_quality = last_part[1]
+    data.pending = next(iter(last_part[0]), None)
+    return data
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of request stages and hot paths.
+
+Durations of stages are recorded by `span` into histograms, which are
+exposed with cache statistics in Prometheus text format by `render`, and
+into timings of the current request, which views send in Server-Timing
+header. Metrics are kept per process.
+"""
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+from timeit import default_timer
+
+from werkzeug.local import Local, release_local
+
+
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+    5, 10,
+)
+# per greenlet if greenlet is installed, like request context of Flask
+REQUEST = Local()
+CACHES = OrderedDict()
+
+
+def escape(value):
+    """
+    Escapes label value.
+    """
+    return unicode(value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+def format_labels(names, values, extra=''):
+    """
+    Returns {name="value",...} label set, empty string if there are none.
+    """
+    labels = [
+        '%s="%s"' % (name, escape(value))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        labels.append(extra)
+    return '{%s}' % ','.join(labels) if labels else ''
+
+
+def format_value(value):
+    """
+    Formats sample value.
+    """
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observed values, per set of label values.
+    """
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = Lock()
+        # label values: [bucket counts, sum, count]
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        """
+        Records observed value.
+        """
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [
+                    [0] * len(self.buckets), 0.0, 0
+                ]
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        """
+        Yields lines of the histogram in Prometheus text format.
+        """
+        yield '# HELP %s %s' % (self.name, self.documentation)
+        yield '# TYPE %s histogram' % self.name
+        with self.lock:
+            series = sorted(
+                (values, list(counts), total, count)
+                for values, (counts, total, count) in self.series.iteritems()
+            )
+        for values, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                yield '%s_bucket%s %d' % (
+                    self.name,
+                    format_labels(self.labels, values, 'le="%s"' % bound),
+                    cumulative,
+                )
+            yield '%s_bucket%s %d' % (
+                self.name, format_labels(self.labels, values, 'le="+Inf"'),
+                count,
+            )
+            labels = format_labels(self.labels, values)
+            yield '%s_sum%s %s' % (self.name, labels, format_value(total))
+            yield '%s_count%s %d' % (self.name, labels, count)
+
+
+REQUEST_SECONDS = Histogram(
+    'presence_analyzer_request_seconds',
+    'Time of handling requests, without streamed bodies.',
+    ('endpoint', 'status'),
+)
+STAGE_SECONDS = Histogram(
+    'presence_analyzer_stage_seconds',
+    'Time spent in stages of handling requests.',
+    ('stage',),
+)
+LOCK_WAIT_SECONDS = Histogram(
+    'presence_analyzer_dataset_lock_wait_seconds',
+    'Time of waiting for lock of dataset being rebuilt.',
+    ('dataset',),
+)
+RELOAD_SECONDS = Histogram(
+    'presence_analyzer_dataset_reload_seconds',
+    'Time of loading data of datasets.',
+    ('dataset',),
+)
+HISTOGRAMS = [
+    REQUEST_SECONDS, STAGE_SECONDS, LOCK_WAIT_SECONDS, RELOAD_SECONDS,
+]
+
+
+def register_cache(name, cache):
+    """
+    Exposes hits and misses of given LRUCache.
+    """
+    CACHES[name] = cache
+
+
+def start_request():
+    """
+    Starts collecting timings of stages of request handled by this thread.
+    """
+    REQUEST.timings = OrderedDict()
+    REQUEST.started = default_timer()
+
+
+def request_timings():
+    """
+    Returns timings collected so far with the total time of request.
+
+    Timings are {stage: [seconds, description]} dict.
+    """
+    timings = getattr(REQUEST, 'timings', None)
+    if timings is None:
+        return OrderedDict()
+    timings['total'] = [default_timer() - REQUEST.started, None]
+    return timings
+
+
+def finish_request():
+    """
+    Stops collecting timings, returns them with the total time of request.
+    """
+    timings = request_timings()
+    # storage is keyed by greenlet or thread, drop it with the request
+    release_local(REQUEST)
+    return timings
+
+
+def record(stage, seconds, description=None):
+    """
+    Adds time spent in given stage to timings of the current request.
+    """
+    STAGE_SECONDS.observe(seconds, stage)
+    timings = getattr(REQUEST, 'timings', None)
+    if timings is not None:
+        timing = timings.setdefault(stage, [0, None])
+        timing[0] += seconds
+        if description is not None:
+            timing[1] = description
+
+
+def in_request(func):
+    """
+    Returns func recording timings into the current request in any thread.
+
+    Meant for work handed over to a thread pool while the request waits.
+    """
+    timings = getattr(REQUEST, 'timings', None)
+
+    @wraps(func)
+    def inner(*args, **kwargs):
+        """
+        Calls func with timings of the request set in the current thread.
+        """
+        if timings is None or getattr(REQUEST, 'timings', None) is timings:
+            return func(*args, **kwargs)
+        REQUEST.timings = timings
+        try:
+            return func(*args, **kwargs)
+        finally:
+            release_local(REQUEST)
+    return inner
+
+
+@contextmanager
+def span(stage, histogram=None, *label_values):
+    """
+    Records time of the block as given stage of the current request.
+
+    Yields dict, `description` set in it is sent in Server-Timing header.
+    Time is also observed by given histogram with given label values.
+    """
+    details = {}
+    started = default_timer()
+    try:
+        yield details
+    finally:
+        seconds = default_timer() - started
+        record(stage, seconds, details.get('description'))
+        if histogram is not None:
+            histogram.observe(seconds, *label_values)
+
+
+def server_timing(timings):
+    """
+    Formats timings as value of Server-Timing header.
+    """
+    metrics = []
+    for stage, (seconds, description) in timings.iteritems():
+        metric = stage
+        if description is not None:
+            metric += ';desc="%s"' % description
+        metrics.append('%s;dur=%.3f' % (metric, seconds * 1000))
+    return ', '.join(metrics)
+
+
+def render():
+    """
+    Returns all metrics in Prometheus text format.
+    """
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+
+    stats = [(name, cache.stats()) for name, cache in CACHES.iteritems()]
+    for metric, key, kind, documentation in [
+            ('hits_total', 'hits', 'counter', 'Number of cache hits.'),
+            ('misses_total', 'misses', 'counter', 'Number of cache misses.'),
+            ('hit_ratio', None, 'gauge', 'Ratio of hits to all lookups.'),
+            ('size', 'size', 'gauge', 'Number of cached items.'),
+    ]:
+        name = 'presence_analyzer_cache_' + metric
+        lines.append('# HELP %s %s' % (name, documentation))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for cache_name, cache_stats in stats:
+            if key is None:
+                lookups = cache_stats['hits'] + cache_stats['misses']
+                value = float(cache_stats['hits']) / lookups if lookups \
+                    else 0.0
+            else:
+                value = cache_stats[key]
+            lines.append('%s%s %s' % (
+                name, format_labels(('cache',), (cache_name,)),
+                format_value(value),
+            ))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling of requests and of the whole process.
+"""
+import sys
+import marshal
+from cProfile import Profile
+from collections import Counter
+from thread import get_ident
+from time import sleep
+from timeit import default_timer
+from uuid import uuid4
+
+from werkzeug.local import Local, release_local
+
+from presence_analyzer.cache import LRUCache
+
+
+PROFILES_KEPT = 20
+SAMPLE_INTERVAL = 0.005
+REQUEST = Local()
+PROFILES = LRUCache(max_size=PROFILES_KEPT)
+
+
+def start_profile():
+    """
+    Starts profiling the request handled by this thread.
+
+    Served by the event loop, the profile also covers other requests handled
+    while this one waits.
+    """
+    REQUEST.profile_id = uuid4().hex
+    REQUEST.profile = Profile()
+    REQUEST.profile.enable()
+
+
+def current_profile_id():
+    """
+    Returns id of profile of the request handled by this thread or None.
+    """
+    return getattr(REQUEST, 'profile_id', None)
+
+
+def finish_profile():
+    """
+    Stops profiling the request handled by this thread.
+
+    Returns id of kept profile or None if the request was not profiled. The
+    last PROFILES_KEPT profiles are kept.
+    """
+    profile = getattr(REQUEST, 'profile', None)
+    if profile is None:
+        return None
+    profile.disable()
+    profile_id = REQUEST.profile_id
+    release_local(REQUEST)
+    PROFILES.set(profile_id, profile)
+    return profile_id
+
+
+def pstats_dump(profile_id):
+    """
+    Returns kept profile in format of `pstats` files or None.
+    """
+    profile = PROFILES.get(profile_id)
+    if profile is None:
+        return None
+    profile.create_stats()
+    # what Profile.dump_stats writes
+    return marshal.dumps(profile.stats)
+
+
+def frame_stack(frame):
+    """
+    Returns names of functions on the stack, starting from the outermost.
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('%s (%s:%d)' % (
+            code.co_name, code.co_filename, code.co_firstlineno
+        ))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def sample(seconds, interval=SAMPLE_INTERVAL):
+    """
+    Samples stacks of all other threads every `interval` for `seconds`.
+
+    Returns Counter of stacks joined with semicolons.
+    """
+    stacks = Counter()
+    current = get_ident()
+    finish = default_timer() + seconds
+    while default_timer() < finish:
+        # pylint: disable=protected-access
+        for thread_id, frame in sys._current_frames().iteritems():
+            if thread_id != current:
+                stacks[';'.join(frame_stack(frame))] += 1
+        sleep(interval)
+    return stacks
+
+
+def collapsed(stacks):
+    """
+    Formats stacks in collapsed format of flame graph tools.
+    """
+    return ''.join(
+        '%s %d\n' % (stack, count) for stack, count in sorted(stacks.items())
+    )
@@ -13,6 +13,7 @@ etc = partial(os.path.join, 'parts', 'etc')
 
 DEPLOY_INI = etc('deploy.ini')
 DEPLOY_CFG = etc('deploy.cfg')
+GEVENT_INI = etc('gevent.ini')
 
 DEBUG_INI = etc('debug.ini')
 DEBUG_CFG = etc('debug.cfg')
@@ -28,8 +29,10 @@ del _buildout_path
 # bin/paster serve parts/etc/deploy.ini
 def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
     from presence_analyzer import app
+    from presence_analyzer.utils import configure_datasets
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    configure_datasets(app.config)
     return app
 
 
@@ -50,12 +53,16 @@ def make_shell():
     return locals()
 
 
-def _serve(action, debug=False, dry_run=False):
-    """Build paster command from 'action' and 'debug' flag."""
+def _serve(action, debug=False, dry_run=False, server='paste'):
+    """Build paster command from 'action', 'debug' flag and 'server'."""
     if debug:
         config = DEBUG_INI
-    else:
+    elif server == 'gevent':
+        config = GEVENT_INI
+    elif server == 'paste':
         config = DEPLOY_INI
+    else:
+        raise SystemExit('Unknown server %r, use paste or gevent' % server)
     argv = ['bin/paster', 'serve', config]
     if action in ('start', 'restart'):
         argv += [action, '--daemon']
@@ -82,8 +89,9 @@ def _serve(action, debug=False, dry_run=False):
 def run():
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
-    # bin/flask-ctl serve [fg|start|stop|restart|status]
-    def action_serve(action=('a', 'start'), dry_run=False):
+    # bin/flask-ctl serve [fg|start|stop|restart|status] [--server=gevent]
+    def action_serve(action=('a', 'start'), dry_run=False,
+                     server=('s', 'paste')):
         """Serve the application.
 
         This command serves a web application that uses a paste.deploy
@@ -92,8 +100,9 @@ def run():
         Options:
          - 'action' is one of [fg|start|stop|restart|status]
          - '--dry-run' print the paster command and exit
+         - '--server' is threaded 'paste' (default) or event loop 'gevent'
         """
-        _serve(action, debug=False, dry_run=dry_run)
+        _serve(action, debug=False, dry_run=dry_run, server=server)
 
     # bin/flask-ctl debug [fg|start|stop|restart|status]
     def action_debug(action=('a', 'start'), dry_run=False):
@@ -110,6 +119,17 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl import_sqlite
+    def action_import_sqlite(debug=False):
+        """Import DATA_CSV into DATA_SQLITE database."""
+        from presence_analyzer.sources import import_csv
+        app = make_app(config=DEBUG_CFG if debug else DEPLOY_CFG)
+        rows = import_csv(
+            app.config['DATA_CSV'], app.config['DATA_SQLITE'],
+            exclude_flagged=app.config.get('DATA_EXCLUDE_FLAGGED'),
+        )
+        print 'Imported %d rows into %s' % (rows, app.config['DATA_SQLITE'])
+
     werkzeug.script.run()
 
 
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Event loop serving mode.
+
+`serve` is a Paste server runner serving the application with gevent WSGI
+server. Every connection is handled by a greenlet instead of a thread, so
+idle and slowly reading clients cost just a little memory each. Nothing
+is monkey-patched, the application and its threads are already imported
+by the time the server is loaded. Rebuilds of datasets are handed over to
+a pool of threads, see `Dataset.executor`. Views using data loaded into
+memory only compute, but with DATA_SOURCE = "sqlite" every request runs its
+queries on the loop, blocking other connections meanwhile (mostly short
+index lookups, exports read rows while streaming). Stack sampling of
+`/profile/sample` is not available in this mode.
+
+Requires optional gevent package, `pip install presence_analyzer[gevent]`.
+"""
+import logging
+
+try:
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    from gevent.threadpool import ThreadPool
+except ImportError:  # pragma: no cover
+    WSGIServer = None  # pylint: disable=invalid-name
+
+from presence_analyzer.dataset import Dataset
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+# pylint: disable=unused-argument, too-many-arguments
+def serve(wsgi_app, global_conf, host='0.0.0.0', port=8080,
+          connections=10000, load_threads=4, backlog=1024):
+    """
+    Serves WSGI application until interrupted.
+
+    Options come from the server section of paste.deploy configuration. At
+    most `connections` are handled at once, datasets are rebuilt by up to
+    `load_threads` threads.
+    """
+    if WSGIServer is None:
+        raise RuntimeError('Event loop serving mode requires gevent')
+    Dataset.executor = ThreadPool(int(load_threads))
+    server = WSGIServer(
+        (host, int(port)), wsgi_app,
+        spawn=Pool(int(connections)), backlog=int(backlog),
+        log=None, error_log=log,
+    )
+    log.info('Serving on http://%s:%s with gevent', host, port)
+    try:
+        server.serve_forever()
+    finally:
+        Dataset.executor = None
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshots of parsed presence data.
+
+Snapshot file consists of a header followed by tables and columns, each one
+aligned to its item size:
+
+- header, see `HEADER`,
+- users table, (user_id, first row, number of rows) int32 triple per user,
+- padding to 8 bytes,
+- statistics table, counts, start sums and end sums of WeekdayStats of every
+  user as 21 doubles (exact for integers up to 2 ** 53),
+- days, starts and ends int32 columns of all users one after another,
+- quality table, (user_id, pending, counts of `ingest.FLAGS`) int32 tuple
+  per user in the quality report, INT_MIN standing for lines without valid
+  user id, pending set for counts of the unterminated last line.
+
+Integers use native byte order, so snapshots are meant to be read on the
+host which wrote them. Snapshots written by a different layout version, byte
+order or for a different state of the source file are ignored.
+
+Snapshot can also be memory-mapped, then columns of users are ctypes arrays
+backed by pages of the file, shared by all processes which map it. Files are
+only ever replaced by rename, so mapped snapshots never change.
+"""
+import os
+import fcntl
+import logging
+import struct
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+from ctypes import c_int
+from hashlib import md5
+from mmap import ACCESS_COPY, mmap
+from tempfile import mkstemp
+
+from presence_analyzer.dataset import file_identity
+from presence_analyzer.ingest import FLAGS
+from presence_analyzer.stats import WeekdayStats
+from presence_analyzer.store import PresenceStore, UserPresence
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+MAGIC = 'PRESENCE'
+VERSION = 2
+BYTE_ORDER = 0x01020304
+# magic, version, byte order, source key, inode, offset, tail length,
+# tail, number of users, number of rows, number of quality rows, whether
+# entry of the unterminated line is pending, its user
+HEADER = struct.Struct('=8sII16sqqI64sIIIIi')
+STATS = struct.Struct('=21d')
+QUALITY_FIELDS = 2 + len(FLAGS)
+NO_USER = -1 << 31
+SUFFIX = '.snapshot'
+
+
+def snapshot_path(path):
+    """
+    Returns path of snapshot of given source file.
+    """
+    return path + SUFFIX
+
+
+def source_key(identity):
+    """
+    Returns digest of source file identity, see `dataset.file_identity`.
+    """
+    return md5(repr(identity)).digest()
+
+
+def align(offset, size=8):
+    """
+    Rounds offset up to the multiple of size.
+    """
+    return -(-offset // size) * size
+
+
+def layout(users, rows, quality=0):
+    """
+    Returns offsets of (users, stats, days, starts, ends, quality, end of
+    file).
+    """
+    users_offset = HEADER.size
+    stats_offset = align(users_offset + users * 12)
+    days_offset = stats_offset + users * 21 * 8
+    starts_offset = days_offset + rows * 4
+    ends_offset = starts_offset + rows * 4
+    quality_offset = ends_offset + rows * 4
+    return (
+        users_offset, stats_offset, days_offset, starts_offset, ends_offset,
+        quality_offset, quality_offset + quality * QUALITY_FIELDS * 4,
+    )
+
+
+def dump(data, identity):
+    """
+    Serializes PresenceStore into snapshot bytes.
+    """
+    user_ids = sorted(data)
+    users = array('i')
+    stats = array('d')
+    days, starts, ends = array('i'), array('i'), array('i')
+    for user_id in user_ids:
+        user = data[user_id]
+        users.extend((user_id, len(days), len(user.days)))
+        stats.extend(user.stats.counts)
+        stats.extend(user.stats.start_sums)
+        stats.extend(user.stats.end_sums)
+        days.extend(user.days)
+        starts.extend(user.starts)
+        ends.extend(user.ends)
+
+    quality = array('i')
+    for pending, report in [(0, data.quality), (1, data.pending_quality)]:
+        for user_id, counts in sorted(report.iteritems()):
+            quality.append(NO_USER if user_id is None else user_id)
+            quality.append(pending)
+            quality.extend(counts[flag] for flag in FLAGS)
+
+    quality_count = len(quality) // QUALITY_FIELDS
+    offsets = layout(len(user_ids), len(days), quality_count)
+    header = HEADER.pack(
+        MAGIC, VERSION, BYTE_ORDER, source_key(identity),
+        data.inode or 0, data.offset, len(data.tail), data.tail,
+        len(user_ids), len(days), quality_count,
+        data.pending is not None, data.pending or 0,
+    )
+    return ''.join([
+        header,
+        users.tostring(),
+        '\0' * (offsets[1] - offsets[0] - len(users) * 4),
+        stats.tostring(),
+        days.tostring(),
+        starts.tostring(),
+        ends.tostring(),
+        quality.tostring(),
+    ])
+
+
+def copy_column(buf, offset, count):
+    """
+    Returns array of `count` integers stored at given offset.
+    """
+    result = array('i')
+    result.fromstring(buf[offset:offset + count * 4])
+    return result
+
+
+def map_column(buf, offset, count):
+    """
+    Returns ctypes array of `count` integers sharing memory of the buffer.
+    """
+    return (c_int * count).from_buffer(buf, offset)
+
+
+def load(buf, identity, column=copy_column):
+    """
+    Deserializes PresenceStore from snapshot bytes.
+
+    Columns are created by `column` function, copied to arrays by default.
+    Returns None if the snapshot does not match given source identity or
+    the current layout.
+    """
+    if len(buf) < HEADER.size:
+        return None
+    (magic, version, byte_order, key, inode, offset, tail_size, tail,
+     user_count, rows, quality_count, has_pending, pending) = \
+        HEADER.unpack_from(buf)
+    offsets = layout(user_count, rows, quality_count)
+    if magic != MAGIC or version != VERSION or byte_order != BYTE_ORDER or \
+            key != source_key(identity) or len(buf) != offsets[-1]:
+        return None
+
+    users = struct.unpack_from('=%di' % (user_count * 3), buf, offsets[0])
+    data = PresenceStore()
+    for i in xrange(user_count):
+        user_id, first, count = users[i * 3:i * 3 + 3]
+        sums = [
+            int(value)
+            for value in STATS.unpack_from(buf, offsets[1] + i * STATS.size)
+        ]
+        data[user_id] = UserPresence(
+            column(buf, offsets[2] + first * 4, count),
+            column(buf, offsets[3] + first * 4, count),
+            column(buf, offsets[4] + first * 4, count),
+            WeekdayStats(sums[:7], sums[7:14], sums[14:]),
+        )
+    data.inode = inode
+    data.offset = offset
+    data.tail = tail[:tail_size]
+
+    quality = struct.unpack_from(
+        '=%di' % (quality_count * QUALITY_FIELDS), buf, offsets[5]
+    )
+    for i in xrange(0, len(quality), QUALITY_FIELDS):
+        user_id, is_pending = quality[i:i + 2]
+        report = data.pending_quality if is_pending else data.quality
+        report[None if user_id == NO_USER else user_id] = Counter(dict(
+            (flag, count)
+            for flag, count in zip(FLAGS, quality[i + 2:i + QUALITY_FIELDS])
+            if count
+        ))
+    data.pending = pending if has_pending else None
+    return data
+
+
+def read_snapshot(path, identity):
+    """
+    Reads snapshot of given source file.
+
+    Returns None if it is missing, broken or describes other state of the
+    source file than given identity.
+    """
+    try:
+        with open(snapshot_path(path), 'rb') as snapshot:
+            return load(snapshot.read(), identity)
+    except (IOError, struct.error):
+        log.debug('Cannot read snapshot of %s', path, exc_info=True)
+        return None
+
+
+def map_snapshot(path, identity):
+    """
+    Memory-maps snapshot of given source file, see `read_snapshot`.
+
+    The mapping is private, so the pages are shared with other processes
+    as long as they are only read. It is closed when the last column backed
+    by it is garbage collected.
+    """
+    try:
+        with open(snapshot_path(path), 'rb') as snapshot:
+            if os.fstat(snapshot.fileno()).st_size < HEADER.size:
+                return None
+            buf = mmap(snapshot.fileno(), 0, access=ACCESS_COPY)
+    except (IOError, OSError):
+        log.debug('Cannot map snapshot of %s', path, exc_info=True)
+        return None
+    try:
+        return load(buf, identity, map_column)
+    except (struct.error, ValueError):
+        log.debug('Cannot map snapshot of %s', path, exc_info=True)
+        return None
+
+
+def write_snapshot(path, identity, data):
+    """
+    Writes snapshot of data parsed from source file with given identity.
+
+    Snapshot is written to a temporary file renamed over the previous one,
+    so readers never see it partially written. Failures are only logged.
+    """
+    try:
+        content = dump(data, identity)
+    except (OverflowError, struct.error):
+        # e.g. user ids out of range of int32 columns
+        log.warning('Cannot write snapshot of %s', path, exc_info=True)
+        return False
+
+    target = snapshot_path(path)
+    directory, name = os.path.split(target)
+    try:
+        handle, temporary = mkstemp(prefix=name, dir=directory or '.')
+    except OSError:
+        log.warning('Cannot write snapshot of %s', path, exc_info=True)
+        return False
+
+    try:
+        with os.fdopen(handle, 'wb') as snapshot:
+            snapshot.write(content)
+        os.rename(temporary, target)
+    except (IOError, OSError):
+        log.warning('Cannot write snapshot of %s', path, exc_info=True)
+        os.unlink(temporary)
+        return False
+    return True
+
+
+@contextmanager
+def build_lock(path):
+    """
+    Holds exclusive lock of snapshot of given source file across processes.
+
+    Yields whether the lock is held, failures to take it are only logged.
+    """
+    try:
+        lock = open(snapshot_path(path) + '.lock', 'a')
+    except IOError:
+        log.warning('Cannot lock snapshot of %s', path, exc_info=True)
+        yield False
+        return
+    with lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        except IOError:
+            log.warning('Cannot lock snapshot of %s', path, exc_info=True)
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_cached(path, load_source, previous=None, shared=False,
+                options=()):
+    """
+    Loads data of given source file using its snapshot.
+
+    `load_source(path, previous)` parses the file, when the snapshot is
+    missing or outdated, and the new snapshot is written. Data is read
+    from the snapshot only by a new process (`previous` is None), unless
+    it is `shared`. Shared data is always memory-mapped from the snapshot,
+    and only one process at a time builds it, the others wait and map it.
+
+    Snapshots of data parsed with other `options` are not used.
+    """
+    # taken before parsing, so snapshot of a file changed meanwhile
+    # does not match it anymore
+    identity = file_identity(path) + tuple(options)
+    if not shared:
+        if previous is None:
+            data = read_snapshot(path, identity)
+            if data is not None:
+                return data
+        data = load_source(path, previous)
+        write_snapshot(path, identity, data)
+        return data
+
+    data = map_snapshot(path, identity)
+    if data is not None:
+        return data
+    with build_lock(path) as locked:
+        if not locked:
+            # e.g. read-only data directory, nothing to share
+            return load_source(path, previous)
+        # other process might have built it meanwhile
+        data = map_snapshot(path, identity)
+        if data is None:
+            data = load_source(path, previous)
+            if write_snapshot(path, identity, data):
+                data = map_snapshot(path, identity) or data
+    return data
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data sources.
+
+Views read presence data through a mapping of user ids to users, which
+provide WeekdayStats of their entries with `stats_between(first, last)` and
+the entries themselves as (day, start, end) tuples with `entries(first,
+last)`. Statistics of a group of users come from `group_stats(user_ids,
+first, last)` and `summaries()` yields the first and the last day and the
+number of days of every user. `quality` is data-quality report of the
+source as {user_id: Counter} dict, see `ingest.parse_rows`. PresenceStore
+implements it in memory, SQLiteSource pushes the aggregation down to SQLite.
+"""
+import os
+import errno
+import sqlite3
+from collections import Counter, Mapping
+from datetime import date
+from tempfile import mkstemp
+from threading import local
+
+from presence_analyzer.ingest import FLAGS, parse_rows
+from presence_analyzer.stats import WeekdayStats
+
+
+SCHEMA = """
+CREATE TABLE presence (
+    user_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,  -- date ordinal
+    start_time INTEGER NOT NULL,  -- seconds since midnight
+    end_time INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+);
+CREATE TABLE users (
+    user_id INTEGER PRIMARY KEY
+);
+CREATE TABLE quality (
+    user_id INTEGER,  -- NULL for lines without valid user id
+    rejected INTEGER NOT NULL,
+    non_positive INTEGER NOT NULL,
+    duplicates INTEGER NOT NULL,
+    outliers INTEGER NOT NULL
+);
+"""
+# date.fromordinal(1) is Monday
+STATS_QUERY = """
+SELECT (day - 1) % 7, COUNT(*), SUM(start_time), SUM(end_time)
+FROM presence
+WHERE day BETWEEN ? AND ?{0}
+GROUP BY 1
+"""
+MAX_VARIABLES = 500
+
+
+def counted(rows, counts):
+    """
+    Yields presence rows counting them per user in `counts` Counter.
+    """
+    for row in rows:
+        counts[row[0]] += 1
+        yield row
+
+
+def import_csv(csv_path, db_path, exclude_flagged=False):
+    """
+    Imports presence CSV file into a new SQLite database.
+
+    The database is built in a temporary file renamed over the previous
+    one, so open sources keep reading consistent data. Like in memory, the
+    last of duplicated entries wins. Data-quality report is stored along,
+    with `exclude_flagged` flagged rows are not imported. Returns number of
+    imported rows.
+    """
+    quality = {}
+    accepted = Counter()
+    directory, name = os.path.split(os.path.abspath(db_path))
+    handle, temporary = mkstemp(prefix=name, dir=directory)
+    os.close(handle)
+    try:
+        connection = sqlite3.connect(temporary)
+        try:
+            connection.executescript(SCHEMA)
+            with open(csv_path, 'rb') as csvfile:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?)',
+                    counted(
+                        parse_rows(csvfile, quality, exclude_flagged),
+                        accepted,
+                    ),
+                )
+            connection.execute(
+                'INSERT INTO users SELECT DISTINCT user_id FROM presence'
+            )
+            for user_id, count in connection.execute(
+                    'SELECT user_id, COUNT(*) FROM presence '
+                    'GROUP BY user_id').fetchall():
+                if accepted[user_id] > count:
+                    quality.setdefault(user_id, Counter())['duplicates'] = \
+                        accepted[user_id] - count
+            connection.executemany(
+                'INSERT INTO quality VALUES (?, ?, ?, ?, ?)',
+                [
+                    [user_id] + [counts[flag] for flag in FLAGS]
+                    for user_id, counts in quality.iteritems()
+                ],
+            )
+            connection.commit()
+            rows = connection.execute(
+                'SELECT COUNT(*) FROM presence'
+            ).fetchone()[0]
+        finally:
+            connection.close()
+        os.rename(temporary, db_path)
+    except:
+        os.unlink(temporary)
+        raise
+    return rows
+
+
+def day_bounds(first, last):
+    """
+    Replaces missing bounds of date range with the first and the last day.
+    """
+    return (
+        1 if first is None else first,
+        date.max.toordinal() if last is None else last,
+    )
+
+
+class SQLiteUser(object):
+    """
+    Presence entries of a single user in SQLite database.
+    """
+
+    def __init__(self, source, user_id):
+        self.source = source
+        self.user_id = user_id
+
+    @property
+    def stats(self):
+        """
+        WeekdayStats of all entries.
+        """
+        return self.stats_between()
+
+    def stats_between(self, first=None, last=None):
+        """
+        Returns WeekdayStats of days from first to last ordinal inclusive.
+        """
+        return self.source.group_stats([self.user_id], first, last)
+
+    def entries(self, first=None, last=None):
+        """
+        Returns iterator of (day, start, end) of days from first to last
+        ordinal inclusive.
+
+        Rows are fetched from the database while they are consumed.
+        """
+        first, last = day_bounds(first, last)
+        return iter(self.source.connection.execute(
+            'SELECT day, start_time, end_time FROM presence '
+            'WHERE user_id = ? AND day BETWEEN ? AND ? ORDER BY day',
+            [self.user_id, first, last],
+        ))
+
+
+class SQLiteSource(Mapping):
+    """
+    Read-only mapping of user ids to SQLiteUser instances.
+
+    Statistics are aggregated by SQLite, using the (user_id, day) primary
+    key, so a request for one user reads only rows of that user. Every
+    thread uses its own connection.
+
+    The database must exist already, see `import_csv`, otherwise IOError is
+    raised instead of creating an empty one.
+    """
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise IOError(
+                errno.ENOENT,
+                'SQLite database is missing, run bin/flask-ctl import_sqlite',
+                path,
+            )
+        self.path = path
+        self.local = local()
+
+    @property
+    def connection(self):
+        """
+        Connection of the current thread.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(self.path)
+        return connection
+
+    def group_stats(self, user_ids=None, first=None, last=None):
+        """
+        Returns WeekdayStats of given users, all by default.
+        """
+        first, last = day_bounds(first, last)
+        if user_ids is None:
+            return self._stats('', [first, last])
+
+        user_ids = list(user_ids)
+        return WeekdayStats.combine(
+            self._stats(
+                ' AND user_id IN ({0})'.format(','.join('?' * len(chunk))),
+                [first, last] + chunk,
+            )
+            for chunk in (
+                user_ids[i:i + MAX_VARIABLES]
+                for i in xrange(0, len(user_ids), MAX_VARIABLES)
+            )
+        )
+
+    @property
+    def quality(self):
+        """
+        Data-quality report stored by `import_csv`.
+        """
+        report = {}
+        for row in self.connection.execute(
+                'SELECT user_id, {0} FROM quality'.format(', '.join(FLAGS))):
+            report[row[0]] = Counter(dict(
+                (flag, count) for flag, count in zip(FLAGS, row[1:]) if count
+            ))
+        return report
+
+    def summaries(self):
+        """
+        Yields (user_id, first day, last day, number of days) of all users.
+        """
+        return iter(self.connection.execute(
+            'SELECT user_id, MIN(day), MAX(day), COUNT(*) FROM presence '
+            'GROUP BY user_id'
+        ))
+
+    def _stats(self, condition, params):
+        """
+        Returns WeekdayStats of presence rows matching given condition.
+        """
+        stats = WeekdayStats()
+        query = STATS_QUERY.format(condition)
+        for weekday, count, starts, ends in self.connection.execute(
+                query, params):
+            stats.counts[weekday] = count
+            stats.start_sums[weekday] = starts
+            stats.end_sums[weekday] = ends
+        return stats
+
+    def __getitem__(self, user_id):
+        if self.connection.execute(
+                'SELECT 1 FROM users WHERE user_id = ?', [user_id]
+        ).fetchone() is None:
+            raise KeyError(user_id)
+        return SQLiteUser(self, user_id)
+
+    def __iter__(self):
+        return (
+            user_id for user_id, in self.connection.execute(
+                'SELECT user_id FROM users ORDER BY user_id'
+            )
+        )
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM users'
+        ).fetchone()[0]
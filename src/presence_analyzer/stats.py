@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Presence statistics computed from columnar data.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import izip
+
+
+class WeekdayStats(object):
+    """
+    Per weekday count of entries and sums of their start and end seconds.
+
+    Total presence is the difference of end and start sums, so everything
+    the statistics views need comes from these three lists of seven items.
+    Methods taking `weekday` aggregate over the whole week when it is None.
+    """
+
+    def __init__(self, counts=None, start_sums=None, end_sums=None):
+        self.counts = counts or [0] * 7
+        self.start_sums = start_sums or [0] * 7
+        self.end_sums = end_sums or [0] * 7
+
+    @classmethod
+    def from_columns(cls, days, starts, ends):
+        """
+        Computes statistics in a single pass over presence columns.
+        """
+        counts = [0] * 7
+        start_sums = [0] * 7
+        end_sums = [0] * 7
+        for day, start, end in izip(days, starts, ends):
+            # date.fromordinal(1) is Monday
+            weekday = (day - 1) % 7
+            counts[weekday] += 1
+            start_sums[weekday] += start
+            end_sums[weekday] += end
+        return cls(counts, start_sums, end_sums)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, WeekdayStats) and
+            self.counts == other.counts and
+            self.start_sums == other.start_sums and
+            self.end_sums == other.end_sums
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __add__(self, other):
+        return WeekdayStats(
+            [a + b for a, b in izip(self.counts, other.counts)],
+            [a + b for a, b in izip(self.start_sums, other.start_sums)],
+            [a + b for a, b in izip(self.end_sums, other.end_sums)],
+        )
+
+    def __sub__(self, other):
+        return WeekdayStats(
+            [a - b for a, b in izip(self.counts, other.counts)],
+            [a - b for a, b in izip(self.start_sums, other.start_sums)],
+            [a - b for a, b in izip(self.end_sums, other.end_sums)],
+        )
+
+    @classmethod
+    def combine(cls, items):
+        """
+        Returns statistics of all entries of given WeekdayStats.
+        """
+        counts = [0] * 7
+        start_sums = [0] * 7
+        end_sums = [0] * 7
+        for stats in items:
+            for weekday in xrange(7):
+                counts[weekday] += stats.counts[weekday]
+                start_sums[weekday] += stats.start_sums[weekday]
+                end_sums[weekday] += stats.end_sums[weekday]
+        return cls(counts, start_sums, end_sums)
+
+    def count(self, weekday=None):
+        """
+        Returns number of entries.
+        """
+        return sum(self.counts) if weekday is None else self.counts[weekday]
+
+    def total(self, weekday=None):
+        """
+        Returns total presence in seconds.
+        """
+        return self._sum(self.end_sums, weekday) - \
+            self._sum(self.start_sums, weekday)
+
+    def mean_presence(self, weekday=None):
+        """
+        Returns mean presence in seconds, zero if there are no entries.
+        """
+        return self._mean(self.total(weekday), weekday)
+
+    def mean_start(self, weekday=None):
+        """
+        Returns mean start in seconds since midnight.
+        """
+        return self._mean(self._sum(self.start_sums, weekday), weekday)
+
+    def mean_end(self, weekday=None):
+        """
+        Returns mean end in seconds since midnight.
+        """
+        return self._mean(self._sum(self.end_sums, weekday), weekday)
+
+    @staticmethod
+    def _sum(sums, weekday):
+        """
+        Returns sum for given weekday or the whole week.
+        """
+        return sum(sums) if weekday is None else sums[weekday]
+
+    def _mean(self, value, weekday):
+        """
+        Divides value by number of entries, returns zero if there are none.
+        """
+        count = self.count(weekday)
+        return float(value) / count if count > 0 else 0
+
+
+class RangeIndex(object):
+    """
+    Per weekday sorted days with prefix sums of their start and end seconds.
+
+    WeekdayStats of any date range are computed with two binary searches
+    and a few subtractions for every weekday.
+    """
+
+    def __init__(self, days, starts, ends):
+        self.days = [array('i') for _ in xrange(7)]
+        self.start_sums = [[0] for _ in xrange(7)]
+        self.end_sums = [[0] for _ in xrange(7)]
+        for day, start, end in izip(days, starts, ends):
+            weekday = (day - 1) % 7
+            self.days[weekday].append(day)
+            self.start_sums[weekday].append(
+                self.start_sums[weekday][-1] + start
+            )
+            self.end_sums[weekday].append(self.end_sums[weekday][-1] + end)
+
+    def stats(self, first=None, last=None):
+        """
+        Returns WeekdayStats of days from first to last ordinal inclusive.
+        """
+        counts, start_sums, end_sums = [], [], []
+        for weekday in xrange(7):
+            days = self.days[weekday]
+            low = 0 if first is None else bisect_left(days, first)
+            high = len(days) if last is None else bisect_right(days, last)
+            high = max(low, high)
+            counts.append(high - low)
+            start_sums.append(
+                self.start_sums[weekday][high] - self.start_sums[weekday][low]
+            )
+            end_sums.append(
+                self.end_sums[weekday][high] - self.end_sums[weekday][low]
+            )
+        return WeekdayStats(counts, start_sums, end_sums)
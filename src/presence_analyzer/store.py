@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Compact columnar storage of presence data.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Mapping
+from datetime import date, time
+
+from presence_analyzer.stats import RangeIndex, WeekdayStats
+
+
+def seconds_to_time(seconds):
+    """
+    Converts seconds since midnight to datetime.time.
+    """
+    return time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def columns(days=(), starts=(), ends=()):
+    """
+    Returns (days, starts, ends) tuple of integer arrays.
+    """
+    return array('i', days), array('i', starts), array('i', ends)
+
+
+class UserPresence(Mapping):
+    """
+    Presence entries of a single user kept in parallel integer columns.
+
+    `days` holds sorted date ordinals, `starts` and `ends` hold seconds since
+    midnight. WeekdayStats of the entries are computed once, when the
+    instance is created at load time, unless given, and kept in `stats`.
+    RangeIndex for statistics of date ranges is built on first use.
+
+    For compatibility it is also a read-only mapping of dates to
+    {'start': datetime.time, 'end': datetime.time} dicts, built on access.
+    """
+
+    def __init__(self, days, starts, ends, stats=None):
+        self.days = days
+        self.starts = starts
+        self.ends = ends
+        if stats is None:
+            stats = WeekdayStats.from_columns(days, starts, ends)
+        self.stats = stats
+        self.range_index = None
+
+    @classmethod
+    def build(cls, days, starts, ends):
+        """
+        Creates instance from unordered columns.
+
+        Columns are sorted by day, for duplicated days the entry appended
+        last wins.
+        """
+        if all(days[i] < days[i + 1] for i in xrange(len(days) - 1)):
+            return cls(days, starts, ends)
+
+        order = {}
+        for i, day in enumerate(days):
+            order[day] = i
+        indexes = [order[day] for day in sorted(order)]
+        return cls(*columns(
+            (days[i] for i in indexes),
+            (starts[i] for i in indexes),
+            (ends[i] for i in indexes),
+        ))
+
+    def index(self, day):
+        """
+        Returns position of given date in columns or -1 if it is missing.
+        """
+        ordinal = day.toordinal()
+        i = bisect_left(self.days, ordinal)
+        if i < len(self.days) and self.days[i] == ordinal:
+            return i
+        return -1
+
+    def bounds(self, first=None, last=None):
+        """
+        Returns slice bounds of days from first to last ordinal inclusive.
+        """
+        low = 0 if first is None else bisect_left(self.days, first)
+        high = len(self.days) if last is None else \
+            bisect_right(self.days, last)
+        return low, max(low, high)
+
+    def entries(self, first=None, last=None):
+        """
+        Yields (day, start, end) of days from first to last ordinal inclusive.
+        """
+        low, high = self.bounds(first, last)
+        for i in xrange(low, high):
+            yield self.days[i], self.starts[i], self.ends[i]
+
+    def stats_between(self, first=None, last=None):
+        """
+        Returns WeekdayStats of days from first to last ordinal inclusive.
+        """
+        if first is None and last is None:
+            return self.stats
+        index = self.range_index
+        if index is None:
+            index = self.range_index = RangeIndex(
+                self.days, self.starts, self.ends
+            )
+        return index.stats(first, last)
+
+    def entry(self, i):
+        """
+        Returns entry at given position in legacy dict format.
+        """
+        return {
+            'start': seconds_to_time(self.starts[i]),
+            'end': seconds_to_time(self.ends[i]),
+        }
+
+    def __getitem__(self, day):
+        i = self.index(day)
+        if i < 0:
+            raise KeyError(day)
+        return self.entry(i)
+
+    def __contains__(self, day):
+        return self.index(day) >= 0
+
+    def __iter__(self):
+        return (date.fromordinal(day) for day in self.days)
+
+    def __len__(self):
+        return len(self.days)
+
+    def iteritems(self):
+        for i, day in enumerate(self.days):
+            yield date.fromordinal(day), self.entry(i)
+
+    def itervalues(self):
+        for i in xrange(len(self.days)):
+            yield self.entry(i)
+
+
+class PresenceStore(dict):
+    """
+    UserPresence instances grouped by user_id.
+
+    `rollup` holds WeekdayStats of all entries of all users, it is updated
+    with every change of users columns.
+
+    Remembers inode of the parsed file, offset of the first byte after the
+    last parsed line and the bytes just before it, so rows appended later
+    can be parsed alone.
+
+    `quality` holds data-quality report of the parsed file as {user_id:
+    Counter} dict. Part of it coming from the unterminated last line, which
+    is parsed again with appended rows, is also kept in `pending_quality`
+    and `pending` is id of user whose entry was parsed from that line.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PresenceStore, self).__init__(*args, **kwargs)
+        self.rollup = getattr(args[0], 'rollup', None) if args else None
+        if self.rollup is None:
+            self.rollup = WeekdayStats.combine(
+                user.stats for user in self.itervalues()
+            )
+        self.inode = None
+        self.offset = 0
+        self.tail = ''
+        self.quality = {}
+        self.pending_quality = {}
+        self.pending = None
+
+    def __setitem__(self, user_id, user):
+        previous = self.get(user_id)
+        if previous is not None:
+            self.rollup -= previous.stats
+        self.rollup += user.stats
+        super(PresenceStore, self).__setitem__(user_id, user)
+
+    def summaries(self):
+        """
+        Yields (user_id, first day, last day, number of days) of all users.
+        """
+        for user_id, user in self.iteritems():
+            if len(user):
+                yield user_id, user.days[0], user.days[-1], len(user)
+
+    def group_stats(self, user_ids=None, first=None, last=None):
+        """
+        Returns WeekdayStats of given users, all by default.
+
+        Unknown users are skipped. Statistics of all users without date
+        range come straight from the rollup.
+        """
+        if user_ids is None and first is None and last is None:
+            return self.rollup
+        if user_ids is None:
+            user_ids = self.iterkeys()
+        return WeekdayStats.combine(
+            self[user_id].stats_between(first, last)
+            for user_id in user_ids if user_id in self
+        )
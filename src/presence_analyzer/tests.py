@@ -4,17 +4,39 @@ Presence analyzer unit tests.
 """
 import os.path
 import json
+import locale
+import pstats
+import sys
+import shutil
+import tempfile
 import datetime
 import unittest
-from time import time
+from collections import Counter
+from array import array
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+from thread import get_ident
+from threading import Thread
+from time import sleep, time
+from urlparse import urljoin
+
+from lxml import etree
 
 # pylint: disable=unused-import, import-error
-from presence_analyzer import main, utils
+from presence_analyzer import (
+    main, utils, views, bench, cache, dataset, directory, ingest, metrics,
+    profiling, store, serving, snapshot, sources
+)
+from presence_analyzer import stats as stats_module
 
 TEST_DATA_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_data.csv'
 )
 
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'sample_data.csv'
+)
+
 TEST_USERS_XML = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_users.xml'
 )
@@ -57,7 +79,48 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.content_type, 'application/json')
         data = json.loads(resp.data)
         self.assertEqual(len(data), 2)
-        self.assertDictEqual(data[0], {u'user_id': 10, u'name': u'User 10'})
+        self.assertDictEqual(
+            data[0],
+            {
+                u'user_id': 10,
+                u'name': u'Adam P.',
+                u'avatar': u'https://intranet.stxnext.pl/api/images/users/141',
+                u'first_seen': u'2013-09-10',
+                u'last_seen': u'2013-09-12',
+                u'days': 3,
+            }
+        )
+        self.assertEqual(data[1][u'name'], u'Adrian K.')
+
+    def test_api_users_not_in_directory(self):
+        """
+        Test users missing in the directory get made up names.
+        """
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        with open(path, 'a') as data_file:
+            data_file.write('\n1,2013-09-14,09:00:00,10:00:00\n')
+        main.app.config.update({'DATA_CSV': path})
+        try:
+            data = json.loads(self.client.get('/api/v1/users').data)
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+            shutil.rmtree(tmpdir)
+        self.assertEqual(
+            [user['user_id'] for user in data], [10, 11, 1]
+        )
+        self.assertEqual(
+            data[2],
+            {
+                u'user_id': 1,
+                u'name': u'User 1',
+                u'avatar': None,
+                u'first_seen': u'2013-09-14',
+                u'last_seen': u'2013-09-14',
+                u'days': 1,
+            }
+        )
 
     def test_api_mean_time_weekday(self):
         """
@@ -116,6 +179,458 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             ]
         )
 
+    def test_api_reflects_data_changes(self):
+        """
+        Test cached views are recomputed when data file changes.
+        """
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path})
+        storage = utils.get_data.dataset
+        check_interval, storage.check_interval = storage.check_interval, 0
+        try:
+            resp = self.client.get('/api/v1/presence_weekday/11')
+            self.assertEqual(json.loads(resp.data)[6], [u'Sat', 0])
+
+            with open(path, 'a') as data_file:
+                data_file.write('\n11,2013-09-14,09:00:00,10:00:00\n')
+            resp = self.client.get('/api/v1/presence_weekday/11')
+            self.assertEqual(json.loads(resp.data)[6], [u'Sat', 3600])
+        finally:
+            storage.check_interval = check_interval
+            shutil.rmtree(tmpdir)
+
+    def test_api_conditional_get(self):
+        """
+        Test ETag and Cache-Control headers and conditional requests.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/11')
+        etag = resp.headers['ETag']
+        self.assertEqual(len(etag), 34)
+        self.assertIn('must-revalidate', resp.headers['Cache-Control'])
+        self.assertIn('max-age=0', resp.headers['Cache-Control'])
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        storage = utils.get_data.dataset
+        storage.snapshot = storage.snapshot._replace(version='changed')
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        storage.reload()
+
+    def test_api_body_is_cached(self):
+        """
+        Test serialized responses are reused.
+        """
+        storage = views.api_mean_start_end.cache
+        storage.clear()
+        first = self.client.get('/api/v1/mean_start_end/10')
+        second = self.client.get('/api/v1/mean_start_end/10')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual((storage.misses, storage.hits), (1, 1))
+
+    def test_api_stats(self):
+        """
+        Test statistics of many users in a single response.
+        """
+        resp = self.client.get(
+            '/api/v1/stats?user_id=11,100&user_id=10'
+            '&metrics=presence_weekday,mean_start_end'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual([item['user_id'] for item in data], [11, 10])
+        self.assertItemsEqual(
+            data[0].keys(), ['user_id', 'presence_weekday', 'mean_start_end']
+        )
+        self.assertEqual(
+            data[0]['presence_weekday'],
+            json.loads(self.client.get('/api/v1/presence_weekday/11').data)
+        )
+        self.assertEqual(
+            data[1]['mean_start_end'], [[9, 55, 54], [17, 10, 26]]
+        )
+
+        resp = self.client.get(
+            '/api/v1/stats?user_id=all',
+            headers={'If-None-Match': resp.headers['ETag']}
+        )
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual([item['user_id'] for item in data], [10, 11])
+        self.assertEqual(len(data[0]), 5)
+        self.assertEqual(
+            data[0]['presence_start_end'],
+            json.loads(self.client.get('/api/v1/presence_start_end/10').data)
+        )
+
+        resp = self.client.get(
+            '/api/v1/stats?user_id=all',
+            headers={'If-None-Match': resp.headers['ETag']}
+        )
+        self.assertEqual(resp.status_code, 304)
+
+    def test_api_stats_streamed(self):
+        """
+        Test statistics of many users are streamed.
+        """
+        expected = self.client.get('/api/v1/stats?user_id=all').data
+        threshold, views.BATCH_STREAM_THRESHOLD = (
+            views.BATCH_STREAM_THRESHOLD, 1
+        )
+        try:
+            resp = self.client.get('/api/v1/stats?user_id=all')
+        finally:
+            views.BATCH_STREAM_THRESHOLD = threshold
+        self.assertEqual(resp.data, expected)
+
+    def test_api_stats_invalid(self):
+        """
+        Test invalid statistics requests.
+        """
+        resp = self.client.get('/api/v1/stats?user_id=10&metrics=unknown')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/stats?user_id=ten')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/stats')
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_api_date_range(self):
+        """
+        Test limiting statistics to date range.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11?from=2013-09-10&to=2013-09-12'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            json.loads(resp.data)[1:6],
+            [[u'Mon', 0], [u'Tue', 16564], [u'Wed', 25321],
+             [u'Thu', 22969], [u'Fri', 0]]
+        )
+        resp = self.client.get('/api/v1/mean_start_end/10?to=2013-09-10')
+        self.assertEqual(json.loads(resp.data), [[9, 39, 5], [17, 59, 52]])
+        resp = self.client.get(
+            '/api/v1/stats?user_id=10&metrics=mean_start_end&from=2013-09-11'
+        )
+        self.assertEqual(
+            json.loads(resp.data)[0]['mean_start_end'],
+            [[10, 4, 19], [16, 45, 44]]
+        )
+        resp = self.client.get('/api/v1/mean_time_weekday/10?from=2013-13-01')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_quality(self):
+        """
+        Test data-quality report.
+        """
+        resp = self.client.get('/api/v1/quality')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), {
+            'total': {
+                'rejected': 0, 'non_positive': 0, 'duplicates': 0,
+                'outliers': 0,
+            },
+            'users': [],
+        })
+
+        main.app.config.update({'DATA_CSV': SAMPLE_DATA_CSV})
+        try:
+            data = json.loads(self.client.get('/api/v1/quality').data)
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        self.assertEqual(data['users'][0], {
+            'user_id': 10, 'rejected': 0, 'non_positive': 2,
+            'duplicates': 0, 'outliers': 1,
+        })
+        self.assertEqual(
+            data['total']['outliers'],
+            sum(user['outliers'] for user in data['users'])
+        )
+
+    def test_api_team(self):
+        """
+        Test statistics of all entries of a group of users.
+        """
+        resp = self.client.get('/api/v1/team/presence_weekday')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        users = [
+            json.loads(self.client.get(
+                '/api/v1/presence_weekday/%d' % user_id
+            ).data)
+            for user_id in (10, 11)
+        ]
+        self.assertEqual(
+            data[1:],
+            [
+                [users[0][i][0], users[0][i][1] + users[1][i][1]]
+                for i in xrange(1, 8)
+            ]
+        )
+
+        resp = self.client.get('/api/v1/team/presence_weekday?user_id=11,12')
+        self.assertEqual(json.loads(resp.data), users[1])
+
+        resp = self.client.get(
+            '/api/v1/team/mean_start_end?user_id=all&to=2013-09-10'
+        )
+        self.assertEqual(json.loads(resp.data), [[9, 24, 49], [15, 55, 22]])
+
+        resp = self.client.get('/api/v1/team/unknown')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_api_export(self):
+        """
+        Test streaming raw presence entries.
+        """
+        resp = self.client.get('/api/v1/export')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'text/csv; charset=utf-8')
+        self.assertTrue(resp.is_streamed)
+        lines = resp.data.splitlines()
+        self.assertEqual(lines[0], 'user_id,date,start,end')
+        self.assertEqual(lines[1], '10,2013-09-10,09:39:05,17:59:52')
+        self.assertEqual(len(lines), 10)
+        self.assertEqual(
+            list(ingest.parse_rows(lines)),
+            [
+                (user_id, day, start, end)
+                for user_id, user in sorted(utils.get_data().iteritems())
+                for day, start, end in user.entries()
+            ]
+        )
+
+        resp = self.client.get(
+            '/api/v1/export?format=ndjson&user_id=11,12&from=2013-09-10'
+        )
+        self.assertEqual(resp.content_type, 'application/x-ndjson')
+        records = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(len(records), 4)
+        self.assertEqual(
+            records[0],
+            {
+                'user_id': 11, 'date': '2013-09-10',
+                'start': '09:19:50', 'end': '13:55:54',
+            }
+        )
+
+        resp = self.client.get('/api/v1/export?format=xml')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_export_batches(self):
+        """
+        Test entries are generated in batches.
+        """
+        batch_size = views.EXPORT_BATCH_SIZE
+        views.EXPORT_BATCH_SIZE = 4
+        try:
+            resp = self.client.get('/api/v1/export')
+            chunks = list(resp.response)
+        finally:
+            views.EXPORT_BATCH_SIZE = batch_size
+        self.assertEqual(
+            [chunk.count('\n') for chunk in chunks], [4, 4, 2]
+        )
+
+    def test_server_timing(self):
+        """
+        Test timings of request stages are sent in Server-Timing header.
+        """
+        utils.get_data.dataset.reload()
+        views.api_presence_start_end.cache.clear()
+        resp = self.client.get('/api/v1/presence_start_end/10')
+        stages = [
+            metric.split(';')[0]
+            for metric in resp.headers['Server-Timing'].split(', ')
+        ]
+        self.assertEqual(
+            stages, ['cache', 'aggregate', 'serialize', 'total']
+        )
+        self.assertIn('cache;desc="miss";dur=', resp.headers['Server-Timing'])
+
+        resp = self.client.get('/api/v1/presence_start_end/10')
+        self.assertTrue(
+            resp.headers['Server-Timing'].startswith('cache;desc="hit";dur=')
+        )
+
+    def test_metrics(self):
+        """
+        Test metrics are exposed in Prometheus text format.
+        """
+        utils.get_data.dataset.reload()
+        self.client.get('/api/v1/mean_start_end/10')
+        self.client.get('/api/v1/mean_start_end/10')
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        lines = resp.data.splitlines()
+        for line in [
+                '# TYPE presence_analyzer_request_seconds histogram',
+                '# TYPE presence_analyzer_cache_hits_total counter',
+        ]:
+            self.assertIn(line, lines)
+        prefixes = [
+            'presence_analyzer_request_seconds_count{'
+            'endpoint="api_mean_start_end",status="200"} ',
+            'presence_analyzer_dataset_reload_seconds_count{'
+            'dataset="get_data"} ',
+            'presence_analyzer_stage_seconds_bucket{stage="serialize",le=',
+            'presence_analyzer_cache_hit_ratio{cache="api_mean_start_end"} ',
+        ]
+        for prefix in prefixes:
+            self.assertTrue(
+                any(line.startswith(prefix) for line in lines), prefix
+            )
+
+    def test_failed_request_timing(self):
+        """
+        Test failed requests are timed with status 500 and leave no timings.
+        """
+        def count():
+            """
+            Returns count of timed failed requests.
+            """
+            series = metrics.REQUEST_SECONDS.series.get(
+                ('api_mean_start_end', 500)
+            )
+            return series[2] if series else 0
+
+        failed = count()
+        main.app.config.update({'DATA_CSV': '/nonexistent/data.csv'})
+        views.api_mean_start_end.cache.clear()
+        resp = self.client.get('/api/v1/mean_start_end/10')
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(count(), failed + 1)
+        self.assertEqual(metrics.REQUEST.__storage__, {})
+
+    def test_profile_failed_request(self):
+        """
+        Test profiling stops when the view fails.
+        """
+        main.app.config.update({
+            'PROFILING': True, 'DATA_CSV': '/nonexistent/data.csv',
+        })
+        try:
+            views.api_mean_start_end.cache.clear()
+            resp = self.client.get(
+                '/api/v1/mean_start_end/10', headers={'X-Profile': '1'}
+            )
+        finally:
+            main.app.config.pop('PROFILING')
+        self.assertEqual(resp.status_code, 500)
+        self.assertIsNone(sys.getprofile())
+        self.assertEqual(profiling.REQUEST.__storage__, {})
+
+    def test_profile_request(self):
+        """
+        Test requests are profiled on demand when profiling is enabled.
+        """
+        resp = self.client.get('/api/v1/mean_start_end/10?_profile=1')
+        self.assertNotIn('X-Profile', resp.headers)
+
+        main.app.config.update({'PROFILING': True})
+        try:
+            views.api_mean_start_end.cache.clear()
+            resp = self.client.get(
+                '/api/v1/mean_start_end/10', headers={'X-Profile': '1'}
+            )
+            profile_id = resp.headers['X-Profile']
+            # nothing is left behind by the request in local storages
+            self.assertEqual(metrics.REQUEST.__storage__, {})
+            self.assertEqual(profiling.REQUEST.__storage__, {})
+            resp = self.client.get('/profile/%s.pstats' % profile_id)
+            missing = self.client.get('/profile/unknown.pstats')
+        finally:
+            main.app.config.pop('PROFILING')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(missing.status_code, 404)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'request.pstats')
+            with open(path, 'wb') as pstats_file:
+                pstats_file.write(resp.data)
+            stats = pstats.Stats(path)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertIn(
+            'api_mean_start_end',
+            [function for _, _, function in stats.stats]
+        )
+        self.assertEqual(
+            self.client.get('/profile/%s.pstats' % profile_id).status_code,
+            404
+        )
+
+    def test_profile_sample(self):
+        """
+        Test sampling stacks of other threads.
+        """
+        self.assertEqual(self.client.get('/profile/sample').status_code, 404)
+
+        stopped = []
+
+        def busy_loop():
+            """
+            Keeps the thread busy until stopped.
+            """
+            while not stopped:
+                sleep(0.001)
+
+        thread = Thread(target=busy_loop)
+        thread.start()
+        main.app.config.update({'PROFILING': True})
+        try:
+            resp = self.client.get('/profile/sample?seconds=0.05')
+            for seconds in ('0', '61', 'x'):
+                self.assertEqual(
+                    self.client.get(
+                        '/profile/sample?seconds=%s' % seconds
+                    ).status_code,
+                    400
+                )
+        finally:
+            main.app.config.pop('PROFILING')
+            stopped.append(True)
+            thread.join()
+        self.assertEqual(resp.status_code, 200)
+        stacks = [
+            line.rsplit(' ', 1) for line in resp.data.splitlines()
+        ]
+        self.assertTrue(any(
+            stack.split(';')[-1].startswith('busy_loop (')
+            for stack, _ in stacks
+        ))
+        self.assertTrue(all(int(count) > 0 for _, count in stacks))
+
+        # the event loop would be blocked while sampling
+        main.app.config.update({'PROFILING': True})
+        dataset.Dataset.executor = ThreadPool(1)
+        try:
+            resp = self.client.get('/profile/sample?seconds=0.05')
+        finally:
+            dataset.Dataset.executor.close()
+            dataset.Dataset.executor = None
+            main.app.config.pop('PROFILING')
+        self.assertEqual(resp.status_code, 501)
+
     def test_not_existing_template(self):
         """
         Test for not existing template/url.
@@ -129,6 +644,10 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         """
         resp = self.client.get('/api/v2/users')
         self.assertEqual(resp.status_code, 200)
+        resp_304 = self.client.get(
+            '/api/v2/users', headers={'If-None-Match': resp.headers['ETag']}
+        )
+        self.assertEqual(resp_304.status_code, 304)
         self.assertEqual(resp.content_type, 'application/json')
         data = json.loads(resp.data)
         self.assertEqual(len(data), 2)
@@ -309,55 +828,1268 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             ]
         )
 
+    def test_configure_datasets(self):
+        """
+        Test configuring datasets and starting background refresh.
+        """
+        utils.configure_datasets({
+            'DATA_REFRESH_INTERVAL': 600,
+            'DATA_MAX_STALENESS': 30,
+            'DATA_CHECK_INTERVAL': 5,
+        })
+        refresher = utils.REFRESHER
+        self.assertTrue(refresher.is_alive())
+        self.assertIsNone(utils.WATCHER)
+        self.assertEqual(utils.get_data.dataset.max_staleness, 30)
+        self.assertEqual(utils.get_data_v2.dataset.check_interval, 5)
+
+        utils.configure_datasets({})
+        refresher.join()
+        self.assertIsNone(utils.REFRESHER)
+        self.assertEqual(utils.get_data.dataset.max_staleness, 0)
+        self.assertEqual(
+            utils.get_data.dataset.check_interval, utils.DATA_CHECK_INTERVAL
+        )
+
+    def test_data_is_cached(self):
+        """
+        Test dataset decorator.
+        """
+        storage = utils.get_data_v2.dataset
+        storage.reload()
+        data = utils.get_data_v2()
+        self.assertIs(utils.get_data_v2(), data)
+
+        storage.snapshot = storage.snapshot._replace(data='test')
+        self.assertEquals(utils.get_data_v2(), 'test')
+
+        storage.snapshot = storage.snapshot._replace(identity=(('test',),))
+        self.assertEquals(utils.get_data_v2(), data)
+        self.assertNotEquals(storage.snapshot.identity, (('test',),))
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    """
+    LRU cache tests.
+    """
+
     def test_is_expired(self):
         """
         Test if given time is expired.
         """
-        self.assertEquals(True, utils.is_expired(1, 1))
-        self.assertEquals(True, utils.is_expired(time(), -10))
-        self.assertEquals(False, utils.is_expired(time(), 600))
-        self.assertEquals(False, utils.is_expired(time(), 20.0))
+        self.assertEquals(True, cache.is_expired(1, 1))
+        self.assertEquals(True, cache.is_expired(time(), -10))
+        self.assertEquals(False, cache.is_expired(time(), 600))
+        self.assertEquals(False, cache.is_expired(time(), 20.0))
 
-    def test_data_is_cached(self):
+    def test_get_and_set(self):
         """
-        Test cache decorator.
+        Test storing and retrieving values.
         """
-        utils.CACHE = {}
-        utils.get_data_v2()
-        self.assertNotEquals({}, utils.CACHE)
-        utils.CACHE['d5678d1d23ed69aff53bbb485fff35eb']['time'] = 1337.1337
-        utils.get_data_v2()
-        self.assertNotEquals(
-            utils.CACHE['d5678d1d23ed69aff53bbb485fff35eb']['time'],
-            1337.1337
+        storage = cache.LRUCache(max_size=2)
+        self.assertIsNone(storage.get('a'))
+        storage.set('a', 1)
+        self.assertEqual(storage.get('a'), 1)
+        self.assertEqual(storage.get('b', 'default'), 'default')
+        self.assertEqual(
+            storage.stats(),
+            {'size': 1, 'max_size': 2, 'hits': 1, 'misses': 2, 'evictions': 0}
         )
-        utils.CACHE['d5678d1d23ed69aff53bbb485fff35eb']['data'] = 'test'
-        self.assertEquals(
-            utils.get_data_v2(),
-            'test'
+
+    def test_lru_eviction(self):
+        """
+        Test least recently used entry is evicted first.
+        """
+        storage = cache.LRUCache(max_size=2)
+        storage.set('a', 1)
+        storage.set('b', 2)
+        storage.get('a')
+        storage.set('c', 3)
+        self.assertIn('a', storage)
+        self.assertNotIn('b', storage)
+        self.assertIn('c', storage)
+        self.assertEqual(len(storage), 2)
+        self.assertEqual(storage.evictions, 1)
+
+    def test_ttl(self):
+        """
+        Test expired entries are treated as missing.
+        """
+        storage = cache.LRUCache(ttl=600)
+        storage.set('a', 1)
+        self.assertEqual(storage.get('a'), 1)
+        storage.ttl = -1
+        self.assertIsNone(storage.get('a'))
+        self.assertNotIn('a', storage)
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.txt')
+        self.write('a')
+        self.calls = []
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, content, path=None):
+        """
+        Replaces content of data file.
+        """
+        with open(path or self.path, 'w') as data_file:
+            data_file.write(content)
+
+    def load(self):
+        """
+        Loads content of data file.
+        """
+        self.calls.append(1)
+        with open(self.path) as data_file:
+            return data_file.read()
+
+    def test_file_identity(self):
+        """
+        Test describing files by path, mtime, size and inode.
+        """
+        identity = dataset.file_identity(self.path)
+        self.assertEqual(identity[0], self.path)
+        self.assertEqual(identity[2], 1)
+        self.assertEqual(identity[3], os.stat(self.path).st_ino)
+        missing = os.path.join(self.tmpdir, 'missing')
+        self.assertEqual(dataset.file_identity(missing), (missing,))
+
+    def test_concurrent_readers(self):
+        """
+        Test only one of concurrent readers rebuilds the snapshot.
+        """
+        def load():
+            """
+            Slow loader.
+            """
+            sleep(0.05)
+            return self.load()
+
+        storage = dataset.Dataset(load, lambda: [self.path])
+        results = []
+        threads = [
+            Thread(target=lambda: results.append(storage.get()))
+            for _ in xrange(10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(results, ['a'] * 10)
+
+    def test_reload_on_change(self):
+        """
+        Test data is reloaded only when its file changes.
+        """
+        storage = dataset.Dataset(self.load, lambda: [self.path])
+        self.assertEqual(storage.get(), 'a')
+        version = storage.snapshot.version
+        self.assertEqual(storage.get(), 'a')
+        self.assertEqual(len(self.calls), 1)
+
+        self.write('bb')
+        self.assertEqual(storage.get(), 'bb')
+        self.assertEqual(len(self.calls), 2)
+        self.assertNotEqual(storage.snapshot.version, version)
+
+        other = os.path.join(self.tmpdir, 'other.txt')
+        self.write('ccc', other)
+        os.rename(other, self.path)
+        self.assertEqual(storage.get(), 'ccc')
+
+        storage.reload()
+        self.assertEqual(len(self.calls), 4)
+
+    def test_check_interval(self):
+        """
+        Test files are not checked again within check interval.
+        """
+        storage = dataset.Dataset(
+            self.load, lambda: [self.path], check_interval=600
         )
-        utils.CACHE['d5678d1d23ed69aff53bbb485fff35eb']['time'] = 1
-        self.assertEquals(
-            utils.get_data_v2(),
+        self.assertEqual(storage.get(), 'a')
+        self.write('bb')
+        self.assertEqual(storage.get(), 'a')
+        self.assertTrue(storage.is_stale(storage.snapshot, force=True))
+        self.assertEqual(storage.get(), 'bb')
+
+        storage.invalidate()
+        storage.get()
+        self.assertEqual(len(self.calls), 3)
+
+    def test_stale_while_revalidate(self):
+        """
+        Test stale snapshot is served while it is rebuilt in the background.
+        """
+        storage = dataset.Dataset(
+            self.load, lambda: [self.path], max_staleness=60
+        )
+        self.assertEqual(storage.get(), 'a')
+
+        self.write('bb')
+        self.assertEqual(storage.get(), 'a')
+        with storage.lock:
+            self.assertEqual(storage.get(), 'bb')
+
+        self.write('ccc')
+        storage.is_stale(storage.snapshot)
+        storage.stale = (storage.snapshot, time() - 61)
+        self.assertEqual(storage.get(), 'ccc')
+
+    def test_executor(self):
+        """
+        Test rebuilds are run by executor and timed in the current request.
+        """
+        threads = []
+
+        def load():
+            """
+            Loader remembering its thread.
+            """
+            threads.append(get_ident())
+            return self.load()
+
+        storage = dataset.Dataset(load, lambda: [self.path])
+        storage.executor = ThreadPool(1)
+        try:
+            metrics.start_request()
+            self.assertEqual(storage.get(), 'a')
+            timings = metrics.finish_request()
+        finally:
+            storage.executor.close()
+        self.assertNotEqual(threads, [get_ident()])
+        self.assertEqual(timings.keys(), ['lock', 'load', 'total'])
+        self.assertIsNone(dataset.Dataset.executor)
+
+    def test_refresher(self):
+        """
+        Test refresher loads datasets and rebuilds changed ones.
+        """
+        storage = dataset.Dataset(
+            self.load, lambda: [self.path], check_interval=600
+        )
+        refresher = dataset.Refresher([storage], 0.01)
+        refresher.start()
+        sleep(0.05)
+        self.assertEqual(self.calls, [1])
+
+        self.write('bb')
+        sleep(0.05)
+        refresher.stop()
+        refresher.join()
+        self.assertEqual(self.calls, [1, 1])
+        self.assertEqual(storage.get(), 'bb')
+
+    @unittest.skipIf(dataset.pyinotify is None, 'pyinotify is not installed')
+    def test_watcher(self):
+        """
+        Test watcher rebuilds dataset when its file changes.
+        """
+        storage = dataset.Dataset(
+            self.load, lambda: [self.path], check_interval=600
+        )
+        storage.get()
+        watcher = dataset.Watcher([storage], timeout=10)
+        watcher.start()
+        self.write('bb')
+        for _ in xrange(100):
+            if storage.snapshot.data == 'bb':
+                break
+            sleep(0.01)
+        watcher.stop()
+        watcher.join()
+        self.assertEqual(storage.snapshot.data, 'bb')
+
+
+class IngestTestCase(unittest.TestCase):
+    """
+    Presence data ingestion tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def append(self, content):
+        """
+        Appends content to data file.
+        """
+        with open(self.path, 'a') as data_file:
+            data_file.write(content)
+
+    def test_parse_rows(self):
+        """
+        Test header, footer and malformed lines are skipped.
+        """
+        rows = list(ingest.parse_rows([
+            'user_id,date,start,end,comment',
+            '10,2013-09-10,09:39:05,17:59:52',
+            '10,2013-13-11,09:19:52,16:07:37',
+            'x,2013-09-12,10:48:46,17:23:51',
+            '11,2013-09-05,09:28:08,15:51:27',
+            '',
+        ]))
+        self.assertEqual(
+            rows,
             [
-                {
-                    'avatar': 'https://intranet.stxnext.pl/api/'
-                              'images/users/141',
-                    'id': '10',
-                    'name': 'Adam P.'
-                },
-                {
-                    'avatar': 'https://intranet.stxnext.pl/api/'
-                              'images/users/176',
-                    'id': '11',
-                    'name': 'Adrian K.'
-                }
+                (10, datetime.date(2013, 9, 10).toordinal(), 34745, 64792),
+                (11, datetime.date(2013, 9, 5).toordinal(), 34088, 57087),
             ]
         )
-        self.assertNotEquals(
-            utils.CACHE['d5678d1d23ed69aff53bbb485fff35eb']['data'],
-            'test'
+
+    def test_parse_date_and_time(self):
+        """
+        Test fixed layout parsing and its fallback.
+        """
+        self.assertEqual(
+            ingest.parse_date('2013-09-10'), datetime.date(2013, 9, 10)
+        )
+        self.assertEqual(
+            ingest.parse_date('2013-9-1'), datetime.date(2013, 9, 1)
+        )
+        self.assertEqual(ingest.parse_seconds('09:39:05'), 34745)
+        self.assertEqual(ingest.parse_seconds('9:39:5'), 34745)
+        self.assertEqual(ingest.parse_seconds('00:00:00'), 0)
+        for value in ('2013-02-29', '2013-+9-10', '2013/09/10', ''):
+            self.assertRaises(ValueError, ingest.parse_date, value)
+        for value in ('24:00:00', '09:60:00', '09:39:60', '09:39:+5', ''):
+            self.assertRaises(ValueError, ingest.parse_seconds, value)
+
+    def test_parsers_agree(self):
+        """
+        Test fixed layout parser returns the same rows as strptime one.
+        """
+        with open(TEST_DATA_CSV) as data_file:
+            lines = data_file.read().splitlines()
+        lines += ['10,2013-9-1,9:00:00,17:0:0', '10,2013-09-31,09:00:00,17:00']
+        self.assertEqual(
+            list(ingest.parse_rows(lines)),
+            list(bench.parse_rows_strptime(lines))
+        )
+
+    def test_incremental_load(self):
+        """
+        Test only appended rows are parsed and previous data stays intact.
+        """
+        data = ingest.load_presence(self.path)
+        self.assertEqual(data.offset, os.path.getsize(self.path) - 31)
+
+        self.append('\n11,2013-09-16,08:00:00,16:00:00\n12,2013-09-16,08:0')
+        updated = ingest.load_presence(self.path, data)
+        self.assertNotIn(12, updated)
+        self.assertEqual(
+            updated[11][datetime.date(2013, 9, 16)],
+            {'start': datetime.time(8, 0), 'end': datetime.time(16, 0)}
+        )
+        self.assertIn(datetime.date(2013, 9, 13), updated[11])
+        self.assertEqual(
+            updated[11].stats,
+            stats_module.WeekdayStats.from_columns(
+                updated[11].days, updated[11].starts, updated[11].ends
+            )
+        )
+        self.assertEqual(data[11].stats.count(), 6)
+        self.assertEqual(updated[11].stats.count(), 7)
+        self.assertEqual(
+            updated.rollup,
+            stats_module.WeekdayStats.combine(
+                user.stats for user in updated.itervalues()
+            )
+        )
+        self.assertEqual(data.rollup.count(), 9)
+        self.assertEqual(updated.rollup.count(), 10)
+        self.assertIs(updated[10], data[10])
+        self.assertNotIn(datetime.date(2013, 9, 16), data[11])
+
+        self.append('0:00,12:00:00\n')
+        updated = ingest.load_presence(self.path, updated)
+        self.assertEqual(
+            updated[12][datetime.date(2013, 9, 16)],
+            {'start': datetime.time(8, 0), 'end': datetime.time(12, 0)}
+        )
+        self.assertEqual(updated.offset, os.path.getsize(self.path))
+
+    def test_quality(self):
+        """
+        Test problems are counted per user while parsing.
+        """
+        self.append(
+            '\n10,2013-09-16,17:00:00,09:00:00'
+            '\n10,2013-09-17,09:00:00,09:00:00'
+            '\n11,2013-09-16,01:00:00,23:00:00'
+            '\n11,2013-13-16,08:00:00,16:00:00'
+            '\nx,2013-09-16,08:00:00,16:00:00'
+            '\n11,2013-09-10,08:00:00,16:00:00'
+            '\n11,2013-09-10,08:00:00,16:00:00\n'
+        )
+        data = ingest.load_presence(self.path)
+        self.assertEqual(data.quality, {
+            10: Counter(non_positive=2),
+            11: Counter(outliers=1, rejected=1, duplicates=2),
+            None: Counter(rejected=1),
+        })
+        self.assertIn(datetime.date(2013, 9, 16), data[10])
+        self.assertEqual(len(data[11]), 7)
+
+        excluded = ingest.load_presence(self.path, exclude_flagged=True)
+        self.assertEqual(excluded.quality, data.quality)
+        self.assertNotIn(datetime.date(2013, 9, 16), excluded[10])
+        self.assertNotIn(datetime.date(2013, 9, 16), excluded[11])
+        self.assertEqual(len(excluded[11]), 6)
+
+    def test_incremental_quality(self):
+        """
+        Test quality report is updated with appended rows only.
+        """
+        data = ingest.load_presence(self.path)
+        self.assertEqual(data.quality, {})
+        self.assertEqual(data.pending, 11)
+
+        self.append(
+            '\n10,2013-09-10,08:00:00,16:00:00\n12,2013-09-16,08:00:00,07:0'
+        )
+        data = ingest.load_presence(self.path, data)
+        self.assertEqual(data.quality, {
+            10: Counter(duplicates=1), 12: Counter(rejected=1),
+        })
+        self.assertEqual(data.pending_quality, {12: Counter(rejected=1)})
+
+        self.append('0:00\n12,2013-09-16,08:00:00,16:00:00')
+        data = ingest.load_presence(self.path, data)
+        self.assertEqual(data.quality, {
+            10: Counter(duplicates=1),
+            12: Counter(non_positive=1, duplicates=1),
+        })
+        self.assertEqual(data.pending, 12)
+
+        self.append('\n')
+        data = ingest.load_presence(self.path, data)
+        self.assertEqual(
+            data.quality, ingest.load_presence(self.path).quality
+        )
+        self.assertEqual(data.pending, None)
+
+    def test_split_lines(self):
+        """
+        Test chunks are split at line ends only.
+        """
+        chunk = 'a,1\nbb,22\nccc,333\ndddd'
+        for count in xrange(1, 8):
+            parts = ingest.split_lines(chunk, count)
+            self.assertEqual(''.join(parts), chunk)
+            self.assertLessEqual(len(parts), count)
+            for part in parts[:-1]:
+                self.assertTrue(part.endswith('\n'))
+        self.assertEqual(ingest.split_lines('', 2), [])
+
+    def test_parallel_load(self):
+        """
+        Test parallel parsing gives the same data as serial one.
+        """
+        # duplicated entries in different chunks, the last one wins
+        self.append(
+            '\n10,2013-09-10,08:00:00,16:00:00\n' * 3 +
+            '11,2013-09-16,08:00:00,16:00:00\n12,2013-09-16,08:0'
+        )
+        min_size = ingest.PARALLEL_MIN_SIZE
+        ingest.PARALLEL_MIN_SIZE = 0
+        try:
+            serial = ingest.load_presence(self.path)
+            parallel = ingest.load_presence(self.path, processes=3)
+            self.assertEqual(parallel, serial)
+            self.assertEqual(parallel.rollup, serial.rollup)
+            self.assertEqual(
+                (parallel.offset, parallel.tail),
+                (serial.offset, serial.tail)
+            )
+            self.assertEqual(
+                parallel[10][datetime.date(2013, 9, 10)]['start'],
+                datetime.time(8, 0)
+            )
+            self.assertEqual(parallel.quality, serial.quality)
+            self.assertEqual(parallel.quality[10]['duplicates'], 3)
+
+            self.append('0:00,12:00:00\n')
+            self.assertEqual(
+                ingest.load_presence(self.path, parallel, processes=2),
+                ingest.load_presence(self.path, serial)
+            )
+        finally:
+            ingest.PARALLEL_MIN_SIZE = min_size
+
+    def test_full_reload(self):
+        """
+        Test truncated, rotated and rewritten files are parsed from scratch.
+        """
+        data = ingest.load_presence(self.path)
+        with open(self.path, 'w') as data_file:
+            data_file.write('12,2013-09-16,08:00:00,16:00:00\n')
+        self.assertItemsEqual(ingest.load_presence(self.path, data), [12])
+
+        data = ingest.load_presence(self.path)
+        os.remove(self.path)
+        shutil.copy(TEST_DATA_CSV, self.path)
+        self.assertItemsEqual(ingest.load_presence(self.path, data), [10, 11])
+
+        self.append('\n')
+        data = ingest.load_presence(self.path)
+        with open(self.path, 'r+') as data_file:
+            data_file.seek(-32, os.SEEK_END)
+            data_file.write('12')
+        self.append('10,2013-09-16,08:00:00,16:00:00\n')
+        self.assertItemsEqual(
+            ingest.load_presence(self.path, data), [10, 11, 12]
+        )
+        self.assertNotIn(12, data)
+
+
+class SnapshotTestCase(unittest.TestCase):
+    """
+    Binary snapshot tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        main.app.config.update({'DATA_CSV': self.path, 'DATA_SNAPSHOT': True})
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.pop('DATA_SNAPSHOT')
+        main.app.config.pop('DATA_MMAP', None)
+        utils.get_data.dataset.reload()
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        """
+        Test snapshot holds the same data, statistics and file position.
+        """
+        data = ingest.load_presence(self.path)
+        identity = dataset.file_identity(self.path)
+        self.assertTrue(snapshot.write_snapshot(self.path, identity, data))
+        self.assertItemsEqual(
+            os.listdir(self.tmpdir), ['data.csv', 'data.csv.snapshot']
+        )
+        loaded = snapshot.read_snapshot(self.path, identity)
+        self.assertEqual(loaded, data)
+        self.assertEqual(loaded.rollup, data.rollup)
+        for user_id in data:
+            self.assertEqual(loaded[user_id].stats, data[user_id].stats)
+        self.assertEqual(
+            (loaded.inode, loaded.offset, loaded.tail, loaded.pending),
+            (data.inode, data.offset, data.tail, data.pending)
+        )
+
+        with open(self.path, 'a') as data_file:
+            data_file.write('\n12,2013-09-16,08:00:00,16:00:00\n')
+        updated = ingest.load_presence(self.path, loaded)
+        self.assertItemsEqual(updated, [10, 11, 12])
+        self.assertIs(updated[10], loaded[10])
+
+    def test_quality(self):
+        """
+        Test snapshot holds quality report.
+        """
+        with open(self.path, 'a') as data_file:
+            data_file.write(
+                '\nx,2013-09-16,08:00:00,16:00:00'
+                '\n10,2013-09-16,18:00:00,16:00:00'
+                '\n10,2013-09-17,08:00:00,1'
+            )
+        data = ingest.load_presence(self.path)
+        identity = dataset.file_identity(self.path)
+        snapshot.write_snapshot(self.path, identity, data)
+        loaded = snapshot.read_snapshot(self.path, identity)
+        self.assertEqual(loaded.quality, {
+            None: Counter(rejected=1),
+            10: Counter(non_positive=1, rejected=1),
+        })
+        self.assertEqual(loaded.pending_quality, data.pending_quality)
+        self.assertEqual(loaded.pending, None)
+
+    def test_outdated_or_broken(self):
+        """
+        Test snapshots of other file states and broken ones are ignored.
+        """
+        data = ingest.load_presence(self.path)
+        identity = dataset.file_identity(self.path)
+        self.assertIsNone(snapshot.read_snapshot(self.path, identity))
+        snapshot.write_snapshot(self.path, identity, data)
+        self.assertIsNone(
+            snapshot.read_snapshot(self.path, identity[:-1] + (0,))
+        )
+
+        path = snapshot.snapshot_path(self.path)
+        with open(path, 'rb') as snapshot_file:
+            content = snapshot_file.read()
+        for broken in ('', content[:-4], 'X' + content[1:]):
+            with open(path, 'wb') as snapshot_file:
+                snapshot_file.write(broken)
+            self.assertIsNone(snapshot.read_snapshot(self.path, identity))
+
+    def test_get_data(self):
+        """
+        Test loader writes snapshot and new processes read it.
+        """
+        storage = utils.get_data.dataset
+        data = storage.reload().data
+        self.assertItemsEqual(data, [10, 11])
+        self.assertTrue(os.path.exists(snapshot.snapshot_path(self.path)))
+
+        # pretend the snapshot was written for different data
+        other = store.PresenceStore({12: data[10]})
+        snapshot.write_snapshot(
+            self.path, dataset.file_identity(self.path), other
+        )
+        self.assertItemsEqual(storage.reload().data, [12])
+
+        with open(self.path, 'a') as data_file:
+            data_file.write('\n')
+        self.assertItemsEqual(storage.reload().data, [10, 11])
+
+
+    def test_user_id_out_of_range(self):
+        """
+        Test data not fitting in snapshot is loaded without it.
+        """
+        with open(self.path, 'a') as data_file:
+            data_file.write('\n3000000000,2013-09-16,08:00:00,16:00:00\n')
+        data = utils.get_data.dataset.reload().data
+        self.assertItemsEqual(data, [10, 11, 3000000000])
+        self.assertEqual(os.listdir(self.tmpdir), ['data.csv'])
+
+        client = main.app.test_client()
+        resp = client.get('/api/v1/mean_start_end/3000000000')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_map_snapshot(self):
+        """
+        Test mapped snapshot shares memory of the file and never changes.
+        """
+        data = ingest.load_presence(self.path)
+        identity = dataset.file_identity(self.path)
+        snapshot.write_snapshot(self.path, identity, data)
+        mapped = snapshot.map_snapshot(self.path, identity)
+        self.assertEqual(mapped, data)
+        self.assertNotIsInstance(mapped[10].days, array)
+        self.assertEqual(list(mapped[11].ends), list(data[11].ends))
+        self.assertEqual(
+            mapped[10].stats_between(*data[10].days[1:3]),
+            data[10].stats_between(*data[10].days[1:3])
+        )
+        self.assertIsNone(snapshot.map_snapshot(self.path, ('other',)))
+
+        with open(self.path, 'a') as data_file:
+            data_file.write('\n11,2013-09-16,08:00:00,16:00:00\n')
+        updated = ingest.load_presence(self.path, mapped)
+        self.assertEqual(len(updated[11]), len(data[11]) + 1)
+        snapshot.write_snapshot(
+            self.path, dataset.file_identity(self.path), updated
+        )
+        self.assertEqual(mapped, data)
+
+    def test_get_data_shared(self):
+        """
+        Test shared data is mapped from the snapshot, also after changes.
+        """
+        main.app.config.update({'DATA_MMAP': True})
+        storage = utils.get_data.dataset
+        data = storage.reload().data
+        self.assertItemsEqual(data, [10, 11])
+        self.assertNotIsInstance(data[10].days, array)
+
+        with open(self.path, 'a') as data_file:
+            data_file.write('\n12,2013-09-16,08:00:00,16:00:00\n')
+        storage.invalidate()
+        updated = storage.current().data
+        self.assertItemsEqual(updated, [10, 11, 12])
+        self.assertNotIsInstance(updated[12].days, array)
+        self.assertItemsEqual(data, [10, 11])
+
+    def test_shared_without_lock(self):
+        """
+        Test data is parsed without sharing if snapshot cannot be locked.
+        """
+        # lock file cannot be opened, like in a read-only directory
+        os.mkdir(snapshot.snapshot_path(self.path) + '.lock')
+        data = snapshot.load_cached(
+            self.path, ingest.load_presence, shared=True
+        )
+        self.assertItemsEqual(data, [10, 11])
+        self.assertIsInstance(data[10].days, array)
+        self.assertFalse(os.path.exists(snapshot.snapshot_path(self.path)))
+
+
+class SQLiteSourceTestCase(unittest.TestCase):
+    """
+    SQLite data source tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'presence.sqlite')
+        main.app.config.update({'DATA_SQLITE': self.path})
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.pop('DATA_SQLITE')
+        main.app.config.pop('DATA_SOURCE', None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_import_csv(self):
+        """
+        Test imported data matches data parsed into memory.
+        """
+        data = ingest.load_presence(SAMPLE_DATA_CSV)
+        self.assertEqual(
+            sources.import_csv(SAMPLE_DATA_CSV, self.path),
+            sum(len(user) for user in data.itervalues())
+        )
+        self.assertEqual(os.listdir(self.tmpdir), ['presence.sqlite'])
+        source = sources.SQLiteSource(self.path)
+        self.assertEqual(list(source), sorted(data))
+        self.assertEqual(len(source), len(data))
+        self.assertNotIn(1, source)
+
+        first = datetime.date(2013, 1, 1).toordinal()
+        last = datetime.date(2013, 6, 30).toordinal()
+        for user_id in data:
+            self.assertEqual(source[user_id].stats, data[user_id].stats)
+            self.assertEqual(
+                source[user_id].stats_between(first, last),
+                data[user_id].stats_between(first, last)
+            )
+        self.assertEqual(source.group_stats(), data.group_stats())
+        self.assertEqual(
+            source.group_stats(xrange(1000), first),
+            data.group_stats(xrange(1000), first)
+        )
+
+    def test_quality(self):
+        """
+        Test imported quality report matches one built in memory.
+        """
+        csv_path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(SAMPLE_DATA_CSV, csv_path)
+        with open(csv_path, 'a') as data_file:
+            data_file.write(
+                'x,2013-09-16,08:00:00,16:00:00\n'
+                '10,2013-13-16,08:00:00,16:00:00\n'
+                '10,2013-09-10,08:00:00,16:00:00\n' * 2
+            )
+        for exclude_flagged in (False, True):
+            data = ingest.load_presence(
+                csv_path, exclude_flagged=exclude_flagged
+            )
+            sources.import_csv(
+                csv_path, self.path, exclude_flagged=exclude_flagged
+            )
+            source = sources.SQLiteSource(self.path)
+            self.assertEqual(source.quality, data.quality)
+            self.assertEqual(source.group_stats(), data.group_stats())
+        self.assertEqual(data.quality[10]['duplicates'], 2)
+
+    def test_missing_database(self):
+        """
+        Test missing database is reported and not created empty.
+        """
+        self.assertRaises(IOError, sources.SQLiteSource, self.path)
+        main.app.config.update({'DATA_SOURCE': 'sqlite'})
+        self.assertRaises(IOError, utils.get_source)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_last_duplicate_wins(self):
+        """
+        Test the last of duplicated entries is imported.
+        """
+        csv_path = os.path.join(self.tmpdir, 'data.csv')
+        with open(csv_path, 'w') as data_file:
+            data_file.write(
+                '10,2013-09-10,09:00:00,17:00:00\n'
+                '10,2013-09-10,10:00:00,17:00:00\n'
+            )
+        self.assertEqual(sources.import_csv(csv_path, self.path), 1)
+        self.assertEqual(
+            sources.SQLiteSource(self.path)[10].stats.mean_start(), 36000
+        )
+
+    def test_views(self):
+        """
+        Test views serve the same statistics from both sources.
+        """
+        client = main.app.test_client()
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        sources.import_csv(TEST_DATA_CSV, self.path)
+        urls = [
+            '/api/v1/users',
+            '/api/v1/presence_weekday/10',
+            '/api/v1/mean_start_end/11?from=2013-09-10',
+            '/api/v1/stats?user_id=all',
+            '/api/v1/team/presence_start_end',
+            '/api/v1/export?to=2013-09-11',
+            '/api/v1/export?format=ndjson&user_id=11',
+            '/api/v1/quality',
+        ]
+        expected = [client.get(url).data for url in urls]
+        main.app.config.update({'DATA_SOURCE': 'sqlite'})
+        self.assertIsInstance(utils.get_source(), sources.SQLiteSource)
+        self.assertEqual([client.get(url).data for url in urls], expected)
+        self.assertEqual(
+            client.get('/api/v1/presence_weekday/1').status_code, 404
+        )
+
+
+class DirectoryTestCase(unittest.TestCase):
+    """
+    User directory tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'users.xml')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_load_directory(self):
+        """
+        Test users are sorted like with strcoll and indexed by id.
+        """
+        names = [u'Żaneta B.', u'Łukasz A.', u'Adam C.', u'Ewa D.', u'adam']
+        with open(self.path, 'w') as users_file:
+            users_file.write(
+                '<?xml version="1.0" encoding="UTF-8" ?><intranet><users>' +
+                ''.join(
+                    '<user id="%d"><avatar>%s</avatar><name>%s</name></user>' %
+                    (i, '/a/%d' % i if i else 'b/0', name.encode('utf-8'))
+                    for i, name in enumerate(names)
+                ) +
+                '</users><server><host>example.com</host>'
+                '<protocol>http</protocol></server></intranet>'
+            )
+        users = directory.load_directory(self.path)
+        self.assertEqual(
+            [user['name'] for user in users],
+            sorted(names, cmp=locale.strcoll)
+        )
+        self.assertIs(users.get_user(1), users.index[1])
+        self.assertEqual(
+            users.get_user(1),
+            {
+                'id': '1',
+                'name': u'Łukasz A.',
+                'avatar': 'http://example.com/a/1',
+            }
+        )
+        self.assertEqual(users.get_user(0)['avatar'], 'http://example.com/b/0')
+        self.assertIsNone(users.get_user(5))
+        self.assertEqual(json.loads(users.body), users)
+
+    def test_get_data_v2_matches_xpath(self):
+        """
+        Test directory is the same as the one built with XPath.
+        """
+        xml = etree.parse(TEST_USERS_XML)
+        server = '%s://%s' % (
+            xml.findtext('./server/protocol'), xml.findtext('./server/host')
+        )
+        self.assertEqual(
+            directory.load_directory(TEST_USERS_XML),
+            [
+                {
+                    'id': user.get('id'),
+                    'avatar': urljoin(server, user.findtext('avatar')),
+                    'name': user.findtext('name'),
+                }
+                for user in xml.xpath('./users/user')
+            ]
+        )
+
+
+class BenchTestCase(unittest.TestCase):
+    """
+    Benchmark suite tests.
+    """
+
+    def test_generate_data(self):
+        """
+        Test generated data can be loaded.
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            csv_path = os.path.join(tmpdir, 'data.csv')
+            xml_path = os.path.join(tmpdir, 'users.xml')
+            rows = bench.generate_csv(csv_path, 3, 1)
+            bench.generate_users_xml(xml_path, 3)
+            data = ingest.load_presence(csv_path)
+            users = directory.load_directory(xml_path)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertItemsEqual(data, [1, 2, 3])
+        self.assertEqual(sum(len(user) for user in data.itervalues()), rows)
+        self.assertGreater(rows, 3 * 200)
+        self.assertEqual(data.rollup.count(5) + data.rollup.count(6), 0)
+        self.assertItemsEqual(users.index, [1, 2, 3])
+
+    def test_run_suite(self):
+        """
+        Test all loaders and views are timed and settings are restored.
+        """
+        config = dict(main.app.config)
+        results = bench.run_suite(2, 1, repeat=1)
+        self.assertEqual(main.app.config, config)
+        self.assertEqual(results['users'], 2)
+        names = [result['name'] for result in results['results']]
+        self.assertEqual(
+            names[:3], ['get_data', 'get_data_v2', 'group_by_weekday']
+        )
+        self.assertIn('/api/v1/stats?user_id=all', names)
+        for result in results['results']:
+            self.assertGreater(result['cold'], 0)
+            self.assertGreater(result['warm'], 0)
+        json.dumps(results)
+
+    def test_run_loaders(self):
+        """
+        Test variants of loaders are compared on generated data.
+        """
+        results = bench.run_loaders(2, 1, repeat=1)
+        self.assertEqual(
+            [(result['name'], result['variant'])
+             for result in results['results']][:4],
+            [
+                ('parse', 'strptime'), ('parse', 'fixed layout'),
+                ('load', 'parse'), ('load', 'snapshot'),
+            ]
+        )
+        self.assertEqual(
+            results['results'][0]['rows'], results['results'][1]['rows']
+        )
+        self.assertEqual(
+            [result['variant'] for result in results['results'][-2:]],
+            ['xpath', 'iterparse']
+        )
+        self.assertFalse(os.path.exists(results['csv']))
+        json.dumps(results)
+
+    def test_read_response(self):
+        """
+        Test reading responses with known length, chunked and until close.
+        """
+        self.assertEqual(
+            bench.read_response(StringIO(
+                'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}extra'
+            )),
+            (200, '{}', True)
+        )
+        self.assertEqual(
+            bench.read_response(StringIO(
+                'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n'
+                'Connection: close\r\n\r\n'
+                '1\r\n[\r\na\r\n1,2,3,4,5]\r\n0\r\n\r\n'
+            )),
+            (200, '[1,2,3,4,5]', False)
+        )
+        self.assertEqual(
+            bench.read_response(StringIO(
+                'HTTP/1.0 404 NOT FOUND\r\n\r\nNot found'
+            )),
+            (404, 'Not found', False)
         )
+        self.assertEqual(
+            bench.percentiles([3, 1, 2], (0, 50, 100)),
+            {'p0': 1, 'p50': 2, 'p100': 3}
+        )
+
+
+@unittest.skipIf(bench.gevent is None, 'gevent is not installed')
+class ServingTestCase(unittest.TestCase):
+    """
+    Event loop serving mode tests.
+    """
+
+    def test_serve(self):
+        """
+        Test served API survives concurrent and idle connections.
+        """
+        server = bench.gevent.spawn(
+            serving.serve, main.app, {}, host='127.0.0.1', port=18421,
+            load_threads=2,
+        )
+        bench.gevent.sleep(0.1)
+        try:
+            self.assertIsNotNone(dataset.Dataset.executor)
+            results = bench.load_test(
+                'http://127.0.0.1:18421/api/v1/presence_weekday/10',
+                connections=20, requests=5, idle=20, timeout=10,
+            )
+        finally:
+            server.kill()
+        self.assertEqual(results['failed'], 0)
+        self.assertGreater(results['requests_per_second'], 0)
+        # greenlets of served requests are not kept by local storages
+        self.assertEqual(metrics.REQUEST.__storage__, {})
+        self.assertIsNone(dataset.Dataset.executor)
+
+
+class MetricsTestCase(unittest.TestCase):
+    """
+    Instrumentation tests.
+    """
+
+    def test_histogram(self):
+        """
+        Test histogram buckets are cumulative and labels are escaped.
+        """
+        histogram = metrics.Histogram(
+            'test_seconds', 'Test.', ('name',), buckets=(0.1, 1)
+        )
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, 'a"b')
+        self.assertEqual(
+            list(histogram.render()),
+            [
+                '# HELP test_seconds Test.',
+                '# TYPE test_seconds histogram',
+                'test_seconds_bucket{name="a\\"b",le="0.1"} 2',
+                'test_seconds_bucket{name="a\\"b",le="1"} 3',
+                'test_seconds_bucket{name="a\\"b",le="+Inf"} 4',
+                'test_seconds_sum{name="a\\"b"} 2.65',
+                'test_seconds_count{name="a\\"b"} 4',
+            ]
+        )
+
+    def test_span(self):
+        """
+        Test spans add up in timings of the current request only.
+        """
+        with metrics.span('outside'):
+            pass
+        metrics.start_request()
+        with metrics.span('load'):
+            pass
+        with metrics.span('load') as details:
+            details['description'] = 'again'
+        timings = metrics.finish_request()
+        self.assertEqual(timings.keys(), ['load', 'total'])
+        self.assertEqual(timings['load'][1], 'again')
+        self.assertGreaterEqual(timings['total'][0], timings['load'][0])
+        self.assertEqual(metrics.finish_request(), {})
+        self.assertRegexpMatches(
+            metrics.server_timing(timings),
+            r'^load;desc="again";dur=\d+\.\d{3}, total;dur=\d+\.\d{3}$'
+        )
+
+    def test_in_request(self):
+        """
+        Test spans in other threads are recorded in the waiting request.
+        """
+        def work():
+            """
+            Timed work.
+            """
+            with metrics.span('work'):
+                pass
+
+        metrics.start_request()
+        for target in (metrics.in_request(work), work):
+            thread = Thread(target=target)
+            thread.start()
+            thread.join()
+        self.assertEqual(metrics.finish_request().keys(), ['work', 'total'])
+        self.assertEqual(metrics.REQUEST.__storage__, {})
+
+
+class StoreTestCase(unittest.TestCase):
+    """
+    Columnar presence store tests.
+    """
+
+    def test_build(self):
+        """
+        Test columns are sorted by day and the last duplicate wins.
+        """
+        user = store.UserPresence.build(*store.columns(
+            [3, 1, 2, 1], [30, 10, 20, 11], [31, 12, 21, 13]
+        ))
+        self.assertEqual(list(user.days), [1, 2, 3])
+        self.assertEqual(list(user.starts), [11, 20, 30])
+        self.assertEqual(list(user.ends), [13, 21, 31])
+
+        days = store.columns([1, 2])[0]
+        self.assertIs(store.UserPresence.build(days, [], []).days, days)
+
+    def test_mapping_adapter(self):
+        """
+        Test user presence works as mapping of dates to legacy dicts.
+        """
+        monday = datetime.date(2013, 9, 9)
+        user = store.UserPresence(*store.columns(
+            [monday.toordinal(), monday.toordinal() + 2],
+            [34745, 0],
+            [64792, 86399],
+        ))
+        self.assertEqual(len(user), 2)
+        self.assertEqual(list(user), [monday, datetime.date(2013, 9, 11)])
+        self.assertIn(monday, user)
+        self.assertNotIn(datetime.date(2013, 9, 10), user)
+        self.assertEqual(
+            user[monday],
+            {
+                'start': datetime.time(9, 39, 5),
+                'end': datetime.time(17, 59, 52),
+            }
+        )
+        self.assertRaises(KeyError, lambda: user[datetime.date(2013, 9, 10)])
+        self.assertEqual(
+            user.items()[1],
+            (
+                datetime.date(2013, 9, 11),
+                {'start': datetime.time(0), 'end': datetime.time(23, 59, 59)}
+            )
+        )
+        self.assertEqual(
+            utils.group_by_weekday(user),
+            [[30047], [], [86399], [], [], [], []]
+        )
+
+
+class StatsTestCase(unittest.TestCase):
+    """
+    Weekday statistics tests.
+    """
+
+    def test_add_and_combine(self):
+        """
+        Test adding, subtracting and combining statistics.
+        """
+        first = stats_module.WeekdayStats(
+            [1] * 7, range(7), range(10, 17)
+        )
+        second = stats_module.WeekdayStats([2] * 7, [5] * 7, [7] * 7)
+        total = first + second
+        self.assertEqual(total.counts, [3] * 7)
+        self.assertEqual(total.end_sums, range(17, 24))
+        self.assertEqual(total - second, first)
+        self.assertEqual(
+            stats_module.WeekdayStats.combine([first, second]), total
+        )
+        self.assertEqual(
+            stats_module.WeekdayStats.combine([]), stats_module.WeekdayStats()
+        )
+
+    def test_range_stats(self):
+        """
+        Test date range statistics agree with statistics of range entries.
+        """
+        main.app.config.update({'DATA_CSV': SAMPLE_DATA_CSV})
+        user = utils.get_data()[10]
+        first_day, last_day = user.days[0], user.days[-1]
+        ranges = [
+            (None, None), (first_day, None), (None, last_day),
+            (first_day + 100, first_day + 200), (first_day - 10, first_day),
+            (last_day, last_day + 10), (last_day + 1, None), (50, 10),
+            (first_day + 33, first_day + 33),
+        ]
+        for first, last in ranges:
+            selected = list(user.entries(first, last))
+            self.assertEqual(selected, [
+                entry for entry in zip(user.days, user.starts, user.ends)
+                if (first is None or entry[0] >= first) and
+                (last is None or entry[0] <= last)
+            ])
+            self.assertEqual(
+                user.stats_between(first, last),
+                stats_module.WeekdayStats.from_columns(
+                    *(zip(*selected) or ([], [], []))
+                )
+            )
+        self.assertIsNotNone(user.range_index)
+
+    def test_from_columns(self):
+        """
+        Test single pass aggregation of presence columns.
+        """
+        monday = datetime.date(2013, 9, 9).toordinal()
+        stats = stats_module.WeekdayStats.from_columns(
+            [monday, monday + 1, monday + 7], [100, 200, 300], [150, 260, 400]
+        )
+        self.assertEqual(stats.counts, [2, 1, 0, 0, 0, 0, 0])
+        self.assertEqual(stats.start_sums, [400, 200, 0, 0, 0, 0, 0])
+        self.assertEqual(stats.end_sums, [550, 260, 0, 0, 0, 0, 0])
+        self.assertEqual(stats.count(), 3)
+        self.assertEqual(stats.total(0), 150)
+        self.assertEqual(stats.total(), 210)
+        self.assertEqual(stats.mean_presence(0), 75.0)
+        self.assertEqual(stats.mean_presence(2), 0)
+        self.assertEqual(stats.mean_start(1), 200.0)
+        self.assertEqual(stats.mean_end(), 270.0)
+        self.assertEqual(stats_module.WeekdayStats().mean_start(), 0)
+
+    def test_matches_grouping(self):
+        """
+        Test statistics agree with grouping entries by weekday.
+        """
+        main.app.config.update({'DATA_CSV': SAMPLE_DATA_CSV})
+        for user in utils.get_data().itervalues():
+            stats = stats_module.WeekdayStats.from_columns(
+                user.days, user.starts, user.ends
+            )
+            self.assertEqual(user.stats, stats)
+            legacy = dict(user.iteritems())
+            grouped = utils.group_by_weekday(legacy)
+            self.assertEqual(
+                [sorted(items) for items in utils.group_by_weekday(user)],
+                [sorted(items) for items in grouped]
+            )
+            for weekday, intervals in enumerate(grouped):
+                self.assertEqual(stats.total(weekday), sum(intervals))
+                self.assertEqual(
+                    stats.mean_presence(weekday), utils.mean(intervals)
+                )
+            starts = [
+                utils.seconds_since_midnight(entry['start'])
+                for entry in legacy.itervalues()
+            ]
+            self.assertEqual(stats.mean_start(), utils.mean(starts))
 
 
 def suite():
@@ -367,6 +2099,17 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(LRUCacheTestCase))
+    base_suite.addTest(unittest.makeSuite(DatasetTestCase))
+    base_suite.addTest(unittest.makeSuite(IngestTestCase))
+    base_suite.addTest(unittest.makeSuite(SnapshotTestCase))
+    base_suite.addTest(unittest.makeSuite(SQLiteSourceTestCase))
+    base_suite.addTest(unittest.makeSuite(DirectoryTestCase))
+    base_suite.addTest(unittest.makeSuite(BenchTestCase))
+    base_suite.addTest(unittest.makeSuite(ServingTestCase))
+    base_suite.addTest(unittest.makeSuite(MetricsTestCase))
+    base_suite.addTest(unittest.makeSuite(StoreTestCase))
+    base_suite.addTest(unittest.makeSuite(StatsTestCase))
     return base_suite
 
 
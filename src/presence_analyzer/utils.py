@@ -2,95 +2,129 @@
 """
 Helper functions used in views.
 """
-import csv
 import logging
 import locale
+import calendar
 from json import dumps
-from functools import wraps
-from datetime import datetime, timedelta
-from urlparse import urljoin
-from threading import Lock
-# pylint: disable=redefined-outer-name
-from time import time
-from cPickle import dumps as pickle_dumps
+from collections import OrderedDict
+from functools import partial, wraps
 from hashlib import md5
+from itertools import izip
+from datetime import datetime, timedelta
 
-from flask import Response
-from lxml import etree
+from flask import Response, abort, request
 
 # pylint: disable=import-error
 from presence_analyzer.main import app
+from presence_analyzer.cache import LRUCache
+from presence_analyzer.dataset import Dataset, Refresher, Switch, Watcher
+from presence_analyzer.directory import load_directory
+from presence_analyzer.ingest import load_presence, parse_date
+from presence_analyzer.metrics import register_cache, span
+from presence_analyzer.snapshot import load_cached
+from presence_analyzer.sources import SQLiteSource
+from presence_analyzer.store import UserPresence
 
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
-LOCK = Lock()
-CACHE = {}
+CACHE_MAX_SIZE = 1024
+DATA_CHECK_INTERVAL = 1
+REFRESHER = None
+WATCHER = None
 locale.setlocale(locale.LC_COLLATE, 'pl_PL.UTF-8')
 
 
-def is_expired(last_time, cache_time):
-    """
-    Checks if given time is expired.
+def dataset(*config_keys, **kwargs):
     """
-    return last_time + cache_time < time()
+    Decorator sharing output of loader between threads.
 
-
-def cache(cache_time):
-    """
-    Decorator for memorize output from function for given time.
+    Output is rebuilt only when any of files named by given config keys
+    changes. Reads of unchanged data are lock-free, see `Dataset`. The dataset
+    itself is available as `dataset` attribute of the decorated function.
+    Loader of `incremental` dataset receives the previously loaded data.
     """
     # pylint: disable=missing-docstring
     def _wrapper(func):
-        @wraps(func)
-        def __wrapper(*args, **kwargs):
-            key = md5(
-                pickle_dumps((func.__name__, args, kwargs))
-            ).hexdigest()
-
-            if key in CACHE and not is_expired(CACHE[key]['time'], cache_time):
-                return CACHE[key]['data']
+        storage = Dataset(
+            func,
+            lambda: [app.config[key] for key in config_keys],
+            check_interval=DATA_CHECK_INTERVAL,
+            incremental=kwargs.get('incremental', False),
+        )
 
-            CACHE[key] = {'time': time(), 'data': func()}
-            return CACHE[key]['data']
+        @wraps(func)
+        def __wrapper():
+            return storage.get()
+        __wrapper.dataset = storage
         return __wrapper
     return _wrapper
 
 
-def locker(func):
+def data_etag(datasets):
     """
-    Decorator prevents for using function at the same time.
+    Returns ETag of the current request based on versions of given datasets.
     """
-    # pylint: disable=missing-docstring
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        with LOCK:
-            return func(*args, **kwargs)
-    return wrapper
+    version = ':'.join(source.current().version for source in datasets)
+    return md5('%s:%s' % (version, request.full_path)).hexdigest()
 
 
-def jsonify(function):
+def cache_headers(response, etag):
     """
-    Creates a response with the JSON representation of wrapped function result.
+    Sets ETag and Cache-Control headers of given response.
     """
-    @wraps(function)
-    def inner(*args, **kwargs):
-        """
-        This docstring will be overridden by @wraps decorator.
-        """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
-        )
-    return inner
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.must_revalidate = True
+    response.cache_control.max_age = app.config.get('API_CACHE_MAX_AGE', 0)
+    return response
 
 
-@locker
-@cache(600)
-def get_data():
+def cached_jsonify(*datasets):
+    """
+    Creates JSON response of wrapped function result and supports
+    conditional GET.
+
+    Responses carry strong ETag derived from versions of given datasets and
+    the request URL, and the body is serialized once per version. Requests
+    with matching If-None-Match get 304 without calling wrapped function.
+    Cache lookup, wrapped function and serialization are timed as `cache`,
+    `aggregate` and `serialize` stages of the request.
+    """
+    # pylint: disable=missing-docstring
+    def _wrapper(function):
+        storage = LRUCache(max_size=CACHE_MAX_SIZE)
+        register_cache(function.__name__, storage)
+
+        @wraps(function)
+        def inner(*args, **kwargs):
+            etag = data_etag(datasets)
+            if request.if_none_match.contains(etag):
+                return cache_headers(Response(status=304), etag)
+
+            with span('cache') as details:
+                body = storage.get(etag)
+                details['description'] = 'miss' if body is None else 'hit'
+            if body is None:
+                with span('aggregate'):
+                    result = function(*args, **kwargs)
+                with span('serialize'):
+                    body = dumps(result)
+                storage.set(etag, body)
+            return cache_headers(
+                Response(body, mimetype='application/json'), etag
+            )
+        inner.cache = storage
+        return inner
+    return _wrapper
+
+
+@dataset('DATA_CSV', incremental=True)
+def get_data(previous=None):
     """
     Extracts presence data from CSV file and groups it by user_id.
 
-    It creates structure like this:
+    Entries of every user are kept in UserPresence columns, which can also
+    be used as mapping like this:
     data = {
         'user_id': {
             datetime.date(2013, 10, 1): {
@@ -103,52 +137,107 @@ def get_data():
             },
         }
     }
+
+    When the file was only appended since `previous` data was loaded, just
+    the new rows are parsed.
+
+    With DATA_SNAPSHOT enabled, parsed data is also saved in a binary
+    snapshot next to the CSV file, and a new process loads it from there
+    instead of parsing the file again, as long as the file did not change.
+    With DATA_MMAP enabled too, columns are memory-mapped from the snapshot
+    and shared by all worker processes. Large files are parsed by
+    DATA_PARSE_PROCESSES processes in parallel.
+
+    Data-quality report is built while parsing, with DATA_EXCLUDE_FLAGGED
+    flagged rows are also left out of the data.
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    path = app.config['DATA_CSV']
+    exclude_flagged = bool(app.config.get('DATA_EXCLUDE_FLAGGED'))
+    load = partial(
+        load_presence, processes=app.config.get('DATA_PARSE_PROCESSES'),
+        exclude_flagged=exclude_flagged,
+    )
+    if not app.config.get('DATA_SNAPSHOT'):
+        return load(path, previous)
+    return load_cached(
+        path, load, previous, shared=app.config.get('DATA_MMAP'),
+        options=['exclude_flagged'] if exclude_flagged else (),
+    )
+
+
+@dataset('DATA_SQLITE')
+def get_sqlite_data():
+    """
+    Returns presence data source reading SQLite database.
+
+    The database is created from DATA_CSV by `flask-ctl import_sqlite`.
+    """
+    return SQLiteSource(app.config['DATA_SQLITE'])
+
+
+def source_dataset():
+    """
+    Returns dataset of presence data source chosen by DATA_SOURCE setting.
+
+    It is either `csv` (the default), parsed into memory by `get_data`, or
+    `sqlite`, see `get_sqlite_data`.
+    """
+    if app.config.get('DATA_SOURCE', 'csv') == 'sqlite':
+        return get_sqlite_data.dataset
+    return get_data.dataset
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+def get_source():
+    """
+    Returns presence data source chosen by DATA_SOURCE setting.
 
-    return data
+    See `presence_analyzer.sources` for its interface.
+    """
+    return get_source.dataset.get()
+get_source.dataset = Switch(source_dataset)
 
 
-@locker
-@cache(600)
+@dataset('XML_FILE_PATH')
 def get_data_v2():
     """
     Return user id dict with names and links to their avatars.
+
+    Users are sorted by name and also indexed by id, see UserDirectory.
     """
-    xml = etree.parse(app.config['XML_FILE_PATH'])
-    api_server = '%s://%s' % (
-        xml.findtext('./server/protocol'), xml.findtext('./server/host')
-    )
+    return load_directory(app.config['XML_FILE_PATH'])
 
-    data = []
-    for user in xml.xpath('./users/user'):
-        data.append(
-            {
-                'id': user.get('id'),
-                'avatar': urljoin(api_server, user.findtext('avatar')),
-                'name': user.findtext('name')
-            }
+
+def configure_datasets(config):
+    """
+    Configures datasets and starts watching their files in the background.
+
+    Uses DATA_CHECK_INTERVAL, DATA_MAX_STALENESS and DATA_REFRESH_INTERVAL
+    settings (in seconds). Files are polled every DATA_REFRESH_INTERVAL
+    seconds if set, and watched with inotify if DATA_WATCH is enabled. Only
+    the presence data source chosen by DATA_SOURCE is watched.
+    """
+    global REFRESHER, WATCHER  # pylint: disable=global-statement
+    for storage in [
+            get_data.dataset, get_sqlite_data.dataset, get_data_v2.dataset
+    ]:
+        storage.check_interval = config.get(
+            'DATA_CHECK_INTERVAL', DATA_CHECK_INTERVAL
         )
+        storage.max_staleness = config.get('DATA_MAX_STALENESS', 0)
 
-    data.sort(key=lambda x: x['name'], cmp=locale.strcoll)
+    for thread in (REFRESHER, WATCHER):
+        if thread is not None:
+            thread.stop()
+    REFRESHER = WATCHER = None
 
-    return data
+    datasets = [source_dataset(), get_data_v2.dataset]
+    interval = config.get('DATA_REFRESH_INTERVAL')
+    if interval:
+        REFRESHER = Refresher(datasets, interval)
+        REFRESHER.start()
+    if config.get('DATA_WATCH'):
+        WATCHER = Watcher(datasets)
+        WATCHER.start()
 
 
 def group_by_weekday(items):
@@ -156,6 +245,12 @@ def group_by_weekday(items):
     Groups presence entries by weekday.
     """
     result = [[], [], [], [], [], [], []]  # one list for every day in week
+    if isinstance(items, UserPresence):
+        for day, start, end in izip(items.days, items.starts, items.ends):
+            # date.fromordinal(1) is Monday
+            result[(day - 1) % 7].append(end - start)
+        return result
+
     for date in items:
         start = items[date]['start']
         end = items[date]['end']
@@ -190,3 +285,114 @@ def seconds_to_hour(seconds):
     """
     date = datetime(1, 1, 1) + timedelta(seconds=seconds)
     return date.timetuple()[3:6]
+
+
+def date_range():
+    """
+    Returns (first, last) date ordinals from `from` and `to` query parameters.
+
+    Missing bounds are None, malformed dates abort with 400.
+    """
+    try:
+        return tuple(
+            parse_date(request.args[name]).toordinal()
+            if request.args.get(name) else None
+            for name in ('from', 'to')
+        )
+    except ValueError:
+        log.debug('Invalid date range %s!', request.args, exc_info=True)
+        abort(400)
+
+
+def mean_time_weekday(stats):
+    """
+    Returns mean presence time grouped by weekday.
+    """
+    return [
+        (calendar.day_abbr[weekday], stats.mean_presence(weekday))
+        for weekday in xrange(7)
+    ]
+
+
+def presence_weekday(stats):
+    """
+    Returns total presence time grouped by weekday, with header row.
+    """
+    result = [
+        (calendar.day_abbr[weekday], stats.total(weekday))
+        for weekday in xrange(7)
+    ]
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def presence_start_end(stats):
+    """
+    Returns avg start and end time grouped by weekday.
+    """
+    return [
+        (
+            calendar.day_abbr[weekday],
+            seconds_to_hour(stats.mean_start(weekday)),
+            seconds_to_hour(stats.mean_end(weekday))
+        )
+        for weekday in xrange(7)
+    ]
+
+
+def mean_start_end(stats):
+    """
+    Returns avg start and end time.
+    """
+    return [
+        seconds_to_hour(stats.mean_start()),
+        seconds_to_hour(stats.mean_end())
+    ]
+
+
+METRICS = OrderedDict([
+    ('mean_time_weekday', mean_time_weekday),
+    ('presence_weekday', presence_weekday),
+    ('presence_start_end', presence_start_end),
+    ('mean_start_end', mean_start_end),
+])
+
+
+def format_seconds(seconds):
+    """
+    Formats seconds since midnight as HH:MM:SS.
+    """
+    return '%02d:%02d:%02d' % (
+        seconds // 3600, seconds // 60 % 60, seconds % 60
+    )
+
+
+def csv_record(user_id, day, start, end):
+    """
+    Returns presence entry as CSV line, in format of DATA_CSV.
+    """
+    return '%d,%s,%s,%s\n' % (
+        user_id,
+        datetime.fromordinal(day).date().isoformat(),
+        format_seconds(start),
+        format_seconds(end),
+    )
+
+
+def ndjson_record(user_id, day, start, end):
+    """
+    Returns presence entry as line of newline delimited JSON.
+    """
+    return dumps(OrderedDict([
+        ('user_id', user_id),
+        ('date', datetime.fromordinal(day).date().isoformat()),
+        ('start', format_seconds(start)),
+        ('end', format_seconds(end)),
+    ])) + '\n'
+
+
+# format: (mimetype, header, function formatting entries)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'user_id,date,start,end\n', csv_record),
+    'ndjson': ('application/x-ndjson', '', ndjson_record),
+}
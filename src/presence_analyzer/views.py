@@ -3,26 +3,172 @@
 Defines views.
 """
 import logging
-import calendar
+from datetime import date
+from json import dumps
 
-from flask import redirect, abort, url_for
+from flask import Response, redirect, abort, request, url_for
 # pylint: disable=no-name-in-module, import-error
 from flask.ext.mako import render_template
 from mako.exceptions import TopLevelLookupException
 
+from presence_analyzer import metrics, profiling
+from presence_analyzer.dataset import Dataset
+from presence_analyzer.directory import sort_key
+from presence_analyzer.ingest import FLAGS
 from presence_analyzer.main import app
 from presence_analyzer.utils import (
-    jsonify,
-    get_data,
+    EXPORT_FORMATS,
+    METRICS,
+    cache_headers,
+    cached_jsonify,
+    data_etag,
+    date_range,
     get_data_v2,
-    mean,
-    group_by_weekday,
-    seconds_since_midnight,
-    seconds_to_hour
+    get_source,
+    mean_time_weekday,
+    presence_weekday,
+    presence_start_end,
+    mean_start_end
 )
 
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+BATCH_STREAM_THRESHOLD = 50
+PROFILE_HEADER = 'X-Profile'
+PROFILE_PARAM = '_profile'
+PROFILE_MAX_SECONDS = 60
+EXPORT_BATCH_SIZE = 1000
+
+
+@app.before_request
+def start_timing():
+    """
+    Starts timing stages of the request.
+    """
+    metrics.start_request()
+
+
+@app.after_request
+def add_server_timing(response):
+    """
+    Sends timings of stages of the request in Server-Timing header.
+    """
+    timings = metrics.request_timings()
+    if timings:
+        response.headers['Server-Timing'] = metrics.server_timing(timings)
+        metrics.REQUEST.status = response.status_code
+    return response
+
+
+@app.teardown_request
+def finish_timing(exc=None):
+    """
+    Records time of handling the request, failed ones with status 500.
+    """
+    status = getattr(metrics.REQUEST, 'status', None)
+    timings = metrics.finish_request()
+    if timings:
+        if exc is not None or status is None:
+            status = 500
+        metrics.REQUEST_SECONDS.observe(
+            timings['total'][0], request.endpoint, status
+        )
+
+
+@app.before_request
+def start_profile():
+    """
+    Profiles the request if asked to and profiling is enabled.
+
+    Profiling is enabled by PROFILING setting and asked for by X-Profile
+    header or `_profile` query parameter.
+    """
+    if app.config.get('PROFILING') and (
+            request.headers.get(PROFILE_HEADER) or
+            request.args.get(PROFILE_PARAM)):
+        profiling.start_profile()
+
+
+@app.after_request
+def add_profile_id(response):
+    """
+    Sends id of profile of the request in X-Profile header.
+
+    The profile is available from `profile_view` once the request finishes.
+    """
+    profile_id = profiling.current_profile_id()
+    if profile_id is not None:
+        response.headers[PROFILE_HEADER] = profile_id
+    return response
+
+
+@app.teardown_request
+def finish_profile(exc=None):
+    """
+    Stops profiling the request, also when the view failed.
+    """
+    profile_id = profiling.finish_profile()
+    if profile_id is not None and exc is not None:
+        log.debug('Profile %s of failed request kept.', profile_id)
+
+
+@app.route('/profile/<profile_id>.pstats', methods=['GET'])
+def profile_view(profile_id):
+    """
+    Returns profile of a request, to be read by `pstats`.
+    """
+    if not app.config.get('PROFILING'):
+        abort(404)
+    dump = profiling.pstats_dump(profile_id)
+    if dump is None:
+        log.debug('Profile %s not found!', profile_id)
+        abort(404)
+    return Response(
+        dump,
+        mimetype='application/octet-stream',
+        headers={
+            'Content-Disposition':
+            'attachment; filename=%s.pstats' % profile_id,
+        },
+    )
+
+
+@app.route('/profile/sample', methods=['GET'])
+def profile_sample_view():
+    """
+    Samples stacks of all threads for `seconds` (1 by default).
+
+    Returns collapsed stacks, which flame graph tools read. Not available
+    when served by the event loop, see `serving`: sampling would block the
+    loop and greenlets of requests are not threads.
+    """
+    if not app.config.get('PROFILING'):
+        abort(404)
+    if Dataset.executor is not None:
+        abort(501)
+    try:
+        seconds = float(request.args.get('seconds', 1))
+    except ValueError:
+        abort(400)
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        abort(400)
+    return Response(
+        profiling.collapsed(profiling.sample(seconds)),
+        mimetype='text/plain',
+        headers={
+            'Content-Disposition': 'attachment; filename=stacks.txt',
+        },
+    )
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Exposes metrics in Prometheus text format.
+    """
+    return Response(
+        metrics.render(), mimetype='text/plain; version=0.0.4'
+    )
 
 
 @app.route('/')
@@ -36,99 +182,86 @@ def mainpage():
 
 
 @app.route('/api/v1/users', methods=['GET'])
-@jsonify
+@cached_jsonify(get_source.dataset, get_data_v2.dataset)
 def api_users_view():
     """
-    Users listing for dropdown.
+    Users listing for dropdown, sorted by name.
+
+    Users with presence data are joined with the user directory by id, names
+    and avatars of users missing there are made up. Every user has the first
+    and the last day with presence data and the number of such days too.
     """
-    data = get_data()
-    return [
-        {'user_id': i, 'name': 'User {0}'.format(str(i))}
-        for i in data.keys()
-    ]
+    users = get_data_v2()
+    result = []
+    for user_id, first, last, days in get_source().summaries():
+        user = users.get_user(user_id) or {}
+        result.append({
+            'user_id': user_id,
+            'name': user.get('name') or 'User {0}'.format(user_id),
+            'avatar': user.get('avatar'),
+            'first_seen': date.fromordinal(first).isoformat(),
+            'last_seen': date.fromordinal(last).isoformat(),
+            'days': days,
+        })
+    result.sort(key=lambda item: (sort_key(item['name']), item['user_id']))
+    return result
 
 
 @app.route('/api/v2/users', methods=['GET'])
-@jsonify
 def api_users_v2_view():
     """
     Users listing with avatars for dropdown.
+
+    The list is serialized once, when it is loaded.
     """
-    return get_data_v2()
+    etag = data_etag([get_data_v2.dataset])
+    if request.if_none_match.contains(etag):
+        return cache_headers(Response(status=304), etag)
+    return cache_headers(
+        Response(get_data_v2().body, mimetype='application/json'), etag
+    )
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
-@jsonify
+@cached_jsonify(get_source.dataset)
 def api_mean_time_weekday(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
     """
-    data = get_data().get(user_id)
+    data = get_source().get(user_id)
     if data is None:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data)
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    return result
+    return mean_time_weekday(data.stats_between(*date_range()))
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
-@jsonify
+@cached_jsonify(get_source.dataset)
 def api_presence_weekday(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data().get(user_id)
+    data = get_source().get(user_id)
     if data is None:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data)
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return presence_weekday(data.stats_between(*date_range()))
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
-@jsonify
+@cached_jsonify(get_source.dataset)
 def api_presence_start_end(user_id):
     """
     Returns avg start and end time of the user.
     """
-    data = get_data().get(user_id)
+    data = get_source().get(user_id)
     if data is None:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    result = {x: {'start': [], 'end': []} for x in xrange(7)}
-
-    for date, val in data.iteritems():
-        result[date.weekday()]['start'].append(
-            seconds_since_midnight(val['start'])
-        )
-        result[date.weekday()]['end'].append(
-            seconds_since_midnight(val['end'])
-        )
-
-    result = [
-        (
-            calendar.day_abbr[weekday],
-            seconds_to_hour(mean(val['start'])),
-            seconds_to_hour(mean(val['end']))
-        )
-        for weekday, val in result.iteritems()
-    ]
-
-    return result
+    return presence_start_end(data.stats_between(*date_range()))
 
 
 @app.route('/<template>')
@@ -143,29 +276,172 @@ def template_param(template):
 
 
 @app.route('/api/v1/mean_start_end/<int:user_id>', methods=['GET'])
-@jsonify
+@cached_jsonify(get_source.dataset)
 def api_mean_start_end(user_id):
     """
     Returns avg start and end time of the user.
     """
-    data = get_data().get(user_id)
+    data = get_source().get(user_id)
     if data is None:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    result = {'start': [], 'end': []}
+    return mean_start_end(data.stats_between(*date_range()))
 
-    for val in data.itervalues():
-        result['start'].append(
-            seconds_since_midnight(val['start'])
-        )
-        result['end'].append(
-            seconds_since_midnight(val['end'])
-        )
 
-    result = [
-        seconds_to_hour(mean(result['start'])),
-        seconds_to_hour(mean(result['end']))
+def split_param(name):
+    """
+    Returns values of comma separated or repeated query parameter.
+    """
+    return [
+        value
+        for param in request.args.getlist(name)
+        for value in param.split(',') if value
     ]
 
-    return result
+
+def user_ids_param(data):
+    """
+    Returns user ids from `user_id` query parameter.
+
+    `all` means ids of all users in given data. Malformed ids abort with 400.
+    """
+    user_ids = split_param('user_id')
+    if user_ids == ['all']:
+        return sorted(data)
+    try:
+        return [int(user_id) for user_id in user_ids]
+    except ValueError:
+        log.debug('Invalid user ids %s!', user_ids)
+        abort(400)
+
+
+@app.route('/api/v1/stats', methods=['GET'])
+def api_stats():
+    """
+    Returns chosen statistics of many users in a single response.
+
+    `user_id` parameter takes user ids or `all`, `metrics` takes names of
+    statistics (all by default). Both may be comma separated or repeated.
+    Statistics may be limited to dates given by `from` and `to` parameters.
+    Unknown users are skipped and responses for many users are streamed.
+    """
+    etag = data_etag([get_source.dataset])
+    if request.if_none_match.contains(etag):
+        return cache_headers(Response(status=304), etag)
+
+    names = split_param('metrics') or METRICS.keys()
+    if any(metric not in METRICS for metric in names):
+        log.debug('Unknown metrics %s!', names)
+        abort(400)
+
+    first, last = date_range()
+    data = get_source()
+    user_ids = user_ids_param(data)
+
+    def generate():
+        """
+        Yields JSON list of users statistics piece by piece.
+        """
+        yield '['
+        separator = ''
+        for user_id in user_ids:
+            user = data.get(user_id)
+            if user is None:
+                continue
+            stats = user.stats_between(first, last)
+            result = {'user_id': user_id}
+            for metric in names:
+                result[metric] = METRICS[metric](stats)
+            yield separator + dumps(result)
+            separator = ','
+        yield ']'
+
+    if len(user_ids) > BATCH_STREAM_THRESHOLD:
+        body = generate()
+    else:
+        body = ''.join(generate())
+    return cache_headers(Response(body, mimetype='application/json'), etag)
+
+
+@app.route('/api/v1/team/<metric>', methods=['GET'])
+@cached_jsonify(get_source.dataset)
+def api_team_view(metric):
+    """
+    Returns chosen statistic of all entries of a group of users.
+
+    The group is given by `user_id` parameter like in `api_stats`, all users
+    by default. Dates may be limited by `from` and `to` parameters.
+    """
+    if metric not in METRICS:
+        log.debug('Metric %s not found!', metric)
+        abort(404)
+
+    data = get_source()
+    user_ids = user_ids_param(data) or None
+    return METRICS[metric](data.group_stats(user_ids, *date_range()))
+
+
+@app.route('/api/v1/quality', methods=['GET'])
+@cached_jsonify(get_source.dataset)
+def api_quality_view():
+    """
+    Returns data-quality report of the presence data.
+
+    Counts of rejected lines, non-positive intervals, duplicated entries and
+    outliers are given in total and for every user with any of them, lines
+    without valid user id are reported with null `user_id`.
+    """
+    total = dict.fromkeys(FLAGS, 0)
+    users = []
+    for user_id, counts in sorted(get_source().quality.iteritems()):
+        user = {'user_id': user_id}
+        for flag in FLAGS:
+            user[flag] = counts[flag]
+            total[flag] += counts[flag]
+        users.append(user)
+    return {'total': total, 'users': users}
+
+
+@app.route('/api/v1/export', methods=['GET'])
+def api_export():
+    """
+    Streams presence entries as CSV or newline delimited JSON.
+
+    `format` parameter is `csv` (the default) or `ndjson`. Entries may be
+    limited to users given by `user_id` parameter like in `api_stats` and to
+    dates given by `from` and `to` parameters. Lines are generated in small
+    batches while the response is sent, so memory use does not depend on
+    the number of exported entries.
+    """
+    etag = data_etag([get_source.dataset])
+    if request.if_none_match.contains(etag):
+        return cache_headers(Response(status=304), etag)
+
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        log.debug('Unknown export format %s!', export_format)
+        abort(400)
+    mimetype, header, record = EXPORT_FORMATS[export_format]
+
+    first, last = date_range()
+    data = get_source()
+    user_ids = user_ids_param(data) or sorted(data)
+
+    def generate():
+        """
+        Yields batches of formatted entries.
+        """
+        lines = [header]
+        for user_id in user_ids:
+            user = data.get(user_id)
+            if user is None:
+                continue
+            for day, start, end in user.entries(first, last):
+                lines.append(record(user_id, day, start, end))
+                if len(lines) >= EXPORT_BATCH_SIZE:
+                    yield ''.join(lines)
+                    lines = []
+        yield ''.join(lines)
+
+    return cache_headers(Response(generate(), mimetype=mimetype), etag)